@@ -1,5 +1,7 @@
-import sys
 import os
+import argparse
+from multiprocessing import Pool
+from chunked_input import get_chunks, read_lines, get_line_offsets, imap_in_order
 
 def assign_ids(input_file, prefix):
   # create numbered train file
@@ -9,9 +11,35 @@ def assign_ids(input_file, prefix):
       example_id = example_id + 1
       numbered_file.write(' '.join([prefix + '_' + str(example_id), input_line]))
 
+def _number_lines(chunk):
+  input_file_name, start, end, prefix, first_example_id = chunk
+  prefix = prefix.encode('utf-8') + b'_'
+  return b''.join(prefix + str(example_id).encode('ascii') + b' ' + input_line
+                  for example_id, input_line in enumerate(read_lines(input_file_name, start, end), first_example_id))
+
+def assign_ids_in_parallel(input_file_name, prefix, num_workers):
+  # ids depend on line numbers, so chunks are counted before they are numbered
+  pool = Pool(processes=num_workers)
+  chunks = get_chunks(input_file_name)
+  line_offsets = get_line_offsets(pool, input_file_name, chunks)
+
+  with open(prefix + '.numbered', 'wb') as numbered_file:
+    for numbered_lines in imap_in_order(pool, _number_lines, [(input_file_name, start, end, prefix, first_example_id) for (start, end), first_example_id in zip(chunks, line_offsets)], 2 * num_workers):
+      numbered_file.write(numbered_lines)
+
+  pool.close()
+  pool.join()
+
 if __name__ == "__main__":
-  assert len(sys.argv) == 2, "need filename"
-  input_file_name = sys.argv[1]
+  parser = argparse.ArgumentParser()
+  parser.add_argument('input_file_name')
+  parser.add_argument('--workers', type=int, default=1,
+                      help="number lines in this many processes, a chunk of the input at a time")
+  args = parser.parse_args()
+  input_file_name = args.input_file_name
 
-  with open(input_file_name) as input_file:
-    assign_ids(input_file, os.path.basename(input_file_name))
+  if args.workers > 1:
+    assign_ids_in_parallel(input_file_name, os.path.basename(input_file_name), args.workers)
+  else:
+    with open(input_file_name) as input_file:
+      assign_ids(input_file, os.path.basename(input_file_name))
@@ -0,0 +1,262 @@
+from __future__ import print_function, division
+import sys
+import os
+import shutil
+import random
+import time
+import tempfile
+import threading
+import subprocess
+import argparse
+import logging
+import json
+import platform
+from multiprocessing import cpu_count
+from timeit import default_timer
+from array import array
+from assign_example_ids import assign_ids
+from scheduler import Scheduler
+from run_experiments import Job
+from server_adapters.runner import Runner
+from standalone_scripts.train_and_test import count_pairs, get_confusion_matrix, get_report, merge_predictions
+
+
+# benchmarks run in a scratch folder
+PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def generate_dataset(filename, num_rows, num_features, density, num_classes, imbalance, seed):
+  """Write num_rows random svmlight lines with labels 1..num_classes and about
+  density * num_features non-zero features each.  Class sizes fall off
+  geometrically so that the biggest class is imbalance times the smallest."""
+  rng = random.Random(seed)
+  class_weights = [imbalance ** (-class_id / max(1, num_classes - 1)) for class_id in range(num_classes)]
+  classes = list(range(1, num_classes + 1))
+  features_per_row = max(1, int(round(density * num_features)))
+
+  with open(filename, 'w') as output_file:
+    for _ in range(num_rows):
+      label = weighted_choice(rng, classes, class_weights)
+      num_row_features = min(num_features, max(1, int(rng.gauss(features_per_row, features_per_row ** 0.5))))
+      features = sorted(rng.sample(range(1, num_features + 1), num_row_features))
+      output_file.write(str(label) + ' ' + ' '.join(str(feature) + ':' + '%.6g' % rng.random() for feature in features) + '\n')
+
+
+def weighted_choice(rng, choices, weights):
+  threshold = rng.random() * sum(weights)
+  for choice, weight in zip(choices, weights):
+    threshold = threshold - weight
+    if threshold < 0:
+      return choice
+  return choices[-1]
+
+
+class FakeRunner(Runner):
+  """Stands in for a server: sleeps for transfer_latency the first time it
+  gets a folder and for about train_latency per svm_params, instead of
+  copying anything or running SVMLight."""
+
+  logger = logging.getLogger('benchmark')
+
+  def __init__(self, name, slots, batch_size, transfer_latency, train_latency, seed):
+    self.name = name
+    self.slots = slots
+    self.batch_size = batch_size
+    self.transfer_latency = transfer_latency
+    self.train_latency = train_latency
+    self.rng = random.Random(seed)
+    self.held_folders = set()
+    self.lock = threading.Lock()
+
+  def __str__(self):
+    return self.name
+
+  def holds(self, folder_name):
+    with self.lock:
+      return folder_name in self.held_folders
+
+  def do_experiment(self, folder_name, svm_params=None):
+    return self.do_experiments(folder_name, [svm_params])[0]
+
+  def do_experiments(self, folder_name, svm_params_list):
+    with self.lock:
+      transfer = folder_name not in self.held_folders
+      self.held_folders.add(folder_name)
+      # up to 50% slower or faster, like real jobs
+      train_latencies = [self.train_latency * self.rng.uniform(0.5, 1.5) for _ in svm_params_list]
+
+    if transfer:
+      time.sleep(self.transfer_latency)
+    time.sleep(sum(train_latencies))
+
+    return [get_report(get_confusion_matrix(count_pairs([1, 2], [1, 2]))) for _ in svm_params_list]
+
+  def _cleanup(self):
+    pass
+
+
+def time_runs(function, repeat, setup=None):
+  seconds = []
+  for _ in range(repeat):
+    if setup is not None:
+      setup()
+    start = default_timer()
+    function()
+    seconds.append(default_timer() - start)
+
+  return {'seconds': seconds, 'min': min(seconds), 'mean': sum(seconds) / len(seconds), 'max': max(seconds)}
+
+
+def benchmark_assign_ids(input_filename, repeat):
+  def run():
+    with open(input_filename) as input_file:
+      assign_ids(input_file, input_filename)
+
+  return time_runs(run, repeat)
+
+
+def benchmark_prepare_files(numbered_filename, num_folds, seed, options, repeat):
+  # each run starts from a folder with nothing but the input, folds file included
+  script_location = os.path.join(PACKAGE_DIRECTORY, 'prepare_files.py')
+  run_directory = 'prepare_files' + '_'.join([''] + [option.strip('-') for option in options])
+
+  def setup():
+    shutil.rmtree(run_directory, ignore_errors=True)
+    os.makedirs(run_directory)
+    shutil.copyfile(numbered_filename, os.path.join(run_directory, 'data.numbered'))
+
+  def run():
+    subprocess.check_call([sys.executable, script_location, os.path.abspath(os.path.join(run_directory, 'data.numbered')), str(num_folds), '--seed', str(seed)] + options,
+                          stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+
+  timings = time_runs(run, repeat, setup)
+  shutil.rmtree(run_directory, ignore_errors=True)
+  return timings
+
+
+def benchmark_evaluation(num_rows, num_classes, seed, repeat):
+  rng = random.Random(seed)
+  actual_classes = array('i', (rng.randint(1, num_classes) for _ in range(num_rows)))
+  predicted_classes = array('i', (rng.randint(1, num_classes) for _ in range(num_rows)))
+
+  return time_runs(lambda: get_report(get_confusion_matrix(count_pairs(predicted_classes, actual_classes))), repeat)
+
+
+def benchmark_merge_predictions(num_rows, num_classes, seed, repeat):
+  rng = random.Random(seed)
+  prediction_directory = 'predictions'
+  shutil.rmtree(prediction_directory, ignore_errors=True)
+  os.makedirs(prediction_directory)
+
+  prediction_filenames = []
+  for class_id in range(1, num_classes + 1):
+    prediction_filenames.append(os.path.join(prediction_directory, 'prediction.class_' + str(class_id)))
+    with open(prediction_filenames[-1], 'w') as prediction_file:
+      for _ in range(num_rows):
+        prediction_file.write('%.8f\n' % rng.uniform(-2, 2))
+
+  return time_runs(lambda: merge_predictions(prediction_filenames, os.path.join(prediction_directory, 'prediction')), repeat)
+
+
+def benchmark_scheduler(num_servers, slots, batch_size, num_folders, num_svm_params, transfer_latency, train_latency, seed, repeat):
+  """Also reports how far the run took longer than if every slot were busy
+  all the time (overhead), which is what the scheduler is responsible for."""
+  def run():
+    scheduler = Scheduler(logging.getLogger('benchmark'))
+    for svm_params_id in range(num_svm_params):
+      for folder_id in range(num_folders):
+        scheduler.submit(Job(directory='folder_' + str(folder_id), svm_params='-c ' + str(svm_params_id)))
+    for server_id in range(num_servers):
+      scheduler.add_server(FakeRunner('server_' + str(server_id), slots, batch_size, transfer_latency, train_latency, seed + server_id))
+    scheduler.wait()
+
+  timings = time_runs(run, repeat)
+  ideal_seconds = (num_folders * num_svm_params * train_latency + num_folders * transfer_latency) / (num_servers * slots)
+  timings['ideal'] = ideal_seconds
+  timings['overhead'] = timings['min'] / ideal_seconds - 1
+  return timings
+
+
+def get_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PACKAGE_DIRECTORY, stderr=open(os.devnull, 'w')).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Time the hot paths of the pipeline on a synthetic dataset and print the results as JSON.")
+  parser.add_argument('--rows', type=int, default=20000)
+  parser.add_argument('--features', type=int, default=10000)
+  parser.add_argument('--density', type=float, default=0.005,
+                      help="fraction of features that are non-zero in a row, on average")
+  parser.add_argument('--classes', type=int, default=10)
+  parser.add_argument('--imbalance', type=float, default=10,
+                      help="size of the biggest class over that of the smallest")
+  parser.add_argument('--folds', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=3,
+                      help="times to run each benchmark; min, mean and max are reported")
+  parser.add_argument('--servers', type=int, default=4,
+                      help="fake servers for the scheduler benchmark")
+  parser.add_argument('--slots', type=int, default=2)
+  parser.add_argument('--batch-size', type=int, default=1)
+  parser.add_argument('--svm-params', type=int, default=8,
+                      help="svm_params per fold folder for the scheduler benchmark")
+  parser.add_argument('--transfer-latency', type=float, default=0.05,
+                      help="seconds a fake server takes to receive a fold folder")
+  parser.add_argument('--train-latency', type=float, default=0.02,
+                      help="seconds a fake server takes per svm_params, on average")
+  parser.add_argument('--output', default=None,
+                      help="write the JSON here instead of to STDOUT")
+  parser.add_argument('--keep', default=None,
+                      help="generate the dataset and outputs in this folder and keep them")
+  args = parser.parse_args()
+
+  logging.getLogger('benchmark').setLevel(logging.CRITICAL)
+
+  if args.keep is not None:
+    work_directory = args.keep
+    if not os.path.isdir(work_directory):
+      os.makedirs(work_directory)
+  else:
+    work_directory = tempfile.mkdtemp(prefix='benchmark_')
+  work_directory = os.path.abspath(work_directory)
+  os.chdir(work_directory)
+
+  try:
+    input_filename = 'data'
+    print("Generating", args.rows, "rows...", file=sys.stderr)
+    generate_dataset(input_filename, args.rows, args.features, args.density, args.classes, args.imbalance, args.seed)
+
+    benchmarks = {}
+    print("Timing assign_ids...", file=sys.stderr)
+    benchmarks['assign_ids'] = benchmark_assign_ids(input_filename, args.repeat)
+    for name, options in [('prepare_files', []), ('prepare_files --single-pass', ['--single-pass']), ('prepare_files --shared-features', ['--shared-features']),
+                          ('prepare_files --binary', ['--binary']), ('prepare_files --workers', ['--workers', str(cpu_count())])]:
+      print("Timing", name + "...", file=sys.stderr)
+      benchmarks[name] = benchmark_prepare_files(input_filename + '.numbered', args.folds, args.seed, options, args.repeat)
+    print("Timing evaluation...", file=sys.stderr)
+    benchmarks['evaluation'] = benchmark_evaluation(args.rows, args.classes, args.seed, args.repeat)
+    print("Timing merge_predictions...", file=sys.stderr)
+    benchmarks['merge_predictions'] = benchmark_merge_predictions(args.rows, args.classes, args.seed, args.repeat)
+    print("Timing the scheduler...", file=sys.stderr)
+    benchmarks['scheduler'] = benchmark_scheduler(args.servers, args.slots, args.batch_size, args.folds, args.svm_params,
+                                                  args.transfer_latency, args.train_latency, args.seed, args.repeat)
+  finally:
+    os.chdir('/')
+    if args.keep is None:
+      shutil.rmtree(work_directory, ignore_errors=True)
+
+  results = {
+    'commit': get_commit(),
+    'python': platform.python_version(),
+    'config': vars(args),
+    'benchmarks': benchmarks,
+  }
+
+  if args.output is not None:
+    with open(args.output, 'w') as output_file:
+      json.dump(results, output_file, indent=2, sort_keys=True)
+  else:
+    print(json.dumps(results, indent=2, sort_keys=True))
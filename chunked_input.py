@@ -0,0 +1,69 @@
+import os
+from collections import deque
+
+
+# big enough that workers spend their time on lines rather than on passing
+# chunks around, small enough that a few per worker fit in memory
+CHUNK_SIZE = 64 << 20
+
+
+def get_chunks(filename, chunk_size=CHUNK_SIZE):
+  """Split filename into (start, end) byte ranges of about chunk_size bytes,
+  each ending right after a newline (or at the end of the file)."""
+  file_size = os.path.getsize(filename)
+  chunks = []
+  with open(filename, 'rb') as input_file:
+    start = 0
+    while start < file_size:
+      input_file.seek(min(start + chunk_size, file_size))
+      input_file.readline()
+      end = min(input_file.tell(), file_size)
+      chunks.append((start, end))
+      start = end
+
+  return chunks
+
+
+def read_chunk(filename, start, end):
+  with open(filename, 'rb') as input_file:
+    input_file.seek(start)
+    return input_file.read(end - start)
+
+
+def read_lines(filename, start, end):
+  """The lines of a chunk, like iterating over the file would give them."""
+  lines = read_chunk(filename, start, end).split(b'\n')
+  last_line = lines.pop()
+  lines = [line + b'\n' for line in lines]
+  if len(last_line) > 0:  # no newline at the end of the file
+    lines.append(last_line)
+  return lines
+
+
+def count_lines(chunk):
+  filename, start, end = chunk
+  data = read_chunk(filename, start, end)
+  return data.count(b'\n') + (1 if len(data) > 0 and not data.endswith(b'\n') else 0)
+
+
+def get_line_offsets(pool, filename, chunks):
+  """Line number of the first line of each chunk, plus the number of lines in
+  the file at the end, counted in parallel."""
+  line_offsets = [0]
+  for num_lines in pool.map(count_lines, [(filename, start, end) for start, end in chunks]):
+    line_offsets.append(line_offsets[-1] + num_lines)
+
+  return line_offsets
+
+
+def imap_in_order(pool, function, arguments, window):
+  """Like pool.imap, but with at most window results computed ahead of the
+  one being consumed, so that a slow consumer doesn't let them pile up."""
+  pending = deque()
+  for argument in arguments:
+    if len(pending) >= window:
+      yield pending.popleft().get()
+    pending.append(pool.apply_async(function, (argument,)))
+
+  while len(pending) > 0:
+    yield pending.popleft().get()
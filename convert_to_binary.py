@@ -0,0 +1,250 @@
+from __future__ import print_function
+import sys
+import os
+import mmap
+import json
+import argparse
+from array import array
+
+
+TYPECODES = {'int32': 'i', 'float64': 'd'}
+try:
+  array('q')
+  TYPECODES['int64'] = 'q'
+except ValueError:  # python 2 has no 'q', but 'l' is 64-bit on 64-bit Linux
+  TYPECODES['int64'] = 'l'
+
+FLUSH_EVERY = 1 << 20
+
+# column name -> type; a column is a raw native-endian array dump
+COLUMNS = {
+  'labels': 'int32',
+  'line_offsets': 'int64',  # byte offset of each line in the text file, plus its size
+  'id_offsets': 'int64',    # offsets into the ids column, plus its size
+  'indptr': 'int64',        # CSR row pointers into indices/values
+  'indices': 'int32',
+  'values': 'float64',
+}
+LABELS_ONLY_COLUMNS = ['labels', 'line_offsets']
+
+
+def get_binary_directory_name(input_file_name):
+  return input_file_name + '.bin'
+
+
+class ColumnWriter(object):
+  def __init__(self, filename, typecode):
+    self.file = open(filename, 'wb')
+    self.typecode = typecode
+    self.buffer = array(typecode)
+
+  def append(self, value):
+    self.buffer.append(value)
+    if len(self.buffer) >= FLUSH_EVERY:
+      self.flush()
+
+  def flush(self):
+    self.buffer.tofile(self.file)
+    self.buffer = array(self.typecode)
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+
+def convert(input_file_name, output_directory=None, has_ids=True, labels_only=False):
+  """Write the columns of an svmlight file (optionally prefixed by example ids,
+  like the .numbered files) to output_directory, which defaults to
+  <input_file_name>.bin."""
+  if output_directory is None:
+    output_directory = get_binary_directory_name(input_file_name)
+
+  if not os.path.isdir(output_directory):
+    os.makedirs(output_directory)
+
+  column_names = LABELS_ONLY_COLUMNS if labels_only else list(COLUMNS.keys())
+  columns = dict((name, ColumnWriter(os.path.join(output_directory, name), TYPECODES[COLUMNS[name]])) for name in column_names)
+  if not labels_only:
+    ids_file = open(os.path.join(output_directory, 'ids'), 'wb')
+
+  num_rows = 0
+  num_features = 0
+  line_offset = 0
+  id_offset = 0
+  nonzeros = 0
+
+  with open(input_file_name, 'rb') as input_file:
+    for input_line in input_file:
+      columns['line_offsets'].append(line_offset)
+      line_offset = line_offset + len(input_line)
+
+      tokens = input_line.split(b'#', 1)[0].split()
+      if has_ids:
+        example_id = tokens[0]
+        tokens = tokens[1:]
+
+      columns['labels'].append(int(tokens[0]))
+      num_rows = num_rows + 1
+
+      if labels_only:
+        continue
+
+      if has_ids:
+        columns['id_offsets'].append(id_offset)
+        ids_file.write(example_id)
+        id_offset = id_offset + len(example_id)
+
+      columns['indptr'].append(nonzeros)
+      for token in tokens[1:]:
+        if token.startswith(b'qid:'):
+          continue
+        index, value = token.split(b':')
+        index = int(index)
+        columns['indices'].append(index)
+        columns['values'].append(float(value))
+        num_features = max(num_features, index)
+        nonzeros = nonzeros + 1
+
+  columns['line_offsets'].append(line_offset)
+  if not labels_only:
+    columns['id_offsets'].append(id_offset)
+    columns['indptr'].append(nonzeros)
+    ids_file.close()
+
+  for column in columns.values():
+    column.close()
+
+  input_stat = os.stat(input_file_name)
+  meta = {
+    'num_rows': num_rows,
+    'num_features': num_features,
+    'num_nonzeros': nonzeros,
+    'has_ids': has_ids,
+    'labels_only': labels_only,
+    'columns': dict((name, COLUMNS[name]) for name in column_names),
+    'byteorder': sys.byteorder,
+    'source_size': input_stat.st_size,
+    'source_mtime': input_stat.st_mtime,
+  }
+  with open(os.path.join(output_directory, 'meta.json'), 'w') as meta_file:
+    json.dump(meta, meta_file)
+
+  return BinaryDataset(output_directory)
+
+
+class BinaryDataset(object):
+  """Read-only, memory-mapped view of a directory written by convert()."""
+
+  def __init__(self, directory):
+    self.directory = directory
+    with open(os.path.join(directory, 'meta.json')) as meta_file:
+      self.meta = json.load(meta_file)
+
+    if self.meta['byteorder'] != sys.byteorder:
+      raise ValueError(directory + " was written on a " + self.meta['byteorder'] + "-endian machine")
+
+    self.num_rows = self.meta['num_rows']
+
+  def column(self, name):
+    typecode = TYPECODES[self.meta['columns'][name]]
+    filename = os.path.join(self.directory, name)
+
+    with open(filename, 'rb') as column_file:
+      size = os.path.getsize(filename)
+      if size == 0:
+        return array(typecode)
+
+      # zero-copy where memoryview can be cast (python 3), otherwise read the column in
+      if hasattr(memoryview, 'cast'):
+        return memoryview(mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+      else:
+        column = array(typecode)
+        column.fromfile(column_file, size // column.itemsize)
+        return column
+
+  def labels(self):
+    return self.column('labels')
+
+  def line_offsets(self):
+    return self.column('line_offsets')
+
+  def has_example_ids(self):
+    return self.meta['has_ids'] and not self.meta['labels_only']
+
+  def example_ids(self):
+    id_offsets = self.column('id_offsets')
+    ids_filename = os.path.join(self.directory, 'ids')
+    if os.path.getsize(ids_filename) == 0:
+      return
+
+    with open(ids_filename, 'rb') as ids_file:
+      ids = mmap.mmap(ids_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    for row in range(self.num_rows):
+      example_id = ids[id_offsets[row]:id_offsets[row + 1]]
+      if not isinstance(example_id, str):
+        example_id = example_id.decode('ascii')
+      yield example_id
+
+  def is_fresh(self, source_file_name):
+    source_stat = os.stat(source_file_name)
+    return self.meta['source_size'] == source_stat.st_size and self.meta['source_mtime'] == source_stat.st_mtime
+
+  def copy_rows(self, source_file_name, rows, output_file, strip_ids=None):
+    """Copy the text of the given rows of source_file_name to output_file
+    (opened in binary mode) without parsing them.  Consecutive rows are
+    copied as one byte range unless their example ids have to be stripped."""
+    if strip_ids is None:
+      strip_ids = self.has_example_ids()
+
+    line_offsets = self.line_offsets()
+    if strip_ids:
+      id_offsets = self.column('id_offsets')
+
+    with open(source_file_name, 'rb') as source_file:
+      if os.path.getsize(source_file_name) == 0:
+        return
+      source = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+      try:
+        range_start = range_end = None
+        for row in rows:
+          if strip_ids:
+            id_length = id_offsets[row + 1] - id_offsets[row]
+            output_file.write(source[line_offsets[row] + id_length + 1:line_offsets[row + 1]])
+          elif row == range_end:
+            range_end = row + 1
+          else:
+            if range_start is not None:
+              output_file.write(source[line_offsets[range_start]:line_offsets[range_end]])
+            range_start, range_end = row, row + 1
+
+        if range_start is not None:
+          output_file.write(source[line_offsets[range_start]:line_offsets[range_end]])
+      finally:
+        source.close()
+
+
+def open_if_fresh(input_file_name):
+  """Return the BinaryDataset converted from input_file_name, or None if there
+  is none or the text file changed since."""
+  directory = get_binary_directory_name(input_file_name)
+  if not os.path.exists(os.path.join(directory, 'meta.json')):
+    return None
+
+  dataset = BinaryDataset(directory)
+  if not dataset.is_fresh(input_file_name):
+    return None
+
+  return dataset
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('input_file_name')
+  parser.add_argument('--no-ids', action='store_true', help="input lines do not start with an example id")
+  parser.add_argument('--labels-only', action='store_true', help="only write the labels and line offsets columns")
+  args = parser.parse_args()
+
+  dataset = convert(args.input_file_name, has_ids=not args.no_ids, labels_only=args.labels_only)
+  print("Wrote", dataset.num_rows, "rows to", dataset.directory, file=sys.stderr)
@@ -4,122 +4,194 @@ import random
 from collections import namedtuple, defaultdict, Counter
 import itertools
 import os
+import shutil
+import argparse
+import json
+from array import array
+from multiprocessing import Pool
+import convert_to_binary
+from chunked_input import CHUNK_SIZE, get_chunks, read_lines, get_line_offsets, imap_in_order
 
+try:
+  from itertools import izip as zip
+except ImportError:
+  pass
 
-class Example():
-  def __init__(self, line_num, klass, example_id, fold):
-    self.line_num = line_num
-    self.klass = klass
-    self.example_id = example_id
-    self.fold = fold
 
+WRITE_BUFFER_SIZE = 1 << 18
+MIN_ROUTING_CHUNK_SIZE = 1 << 20
+MANIFEST_FILENAME = 'manifest.json'
 
-def get_examples_indexed_by_class(input_file):
-  examples = defaultdict(list)
 
-  for line_num, input_line in enumerate(input_file):
-    example_id, klass = input_line.split(" ", 3)[:2]
-    examples[klass].append(Example(line_num=line_num, klass=klass, example_id=example_id, fold=None))
-  
-  return examples
+def get_labels(input_file):
+  for input_line in input_file:
+    yield input_line.split(" ", 2)[1]
 
 
-def get_total_number_of_examples(examples):
+def get_example_ids(input_file):
+  for input_line in input_file:
+    yield input_line.split(" ", 1)[0]
+
+
+def get_line_numbers_indexed_by_class(labels):
+  # one compact int32 column of line numbers per (interned) class label
+  # instead of an object per example
+  line_numbers = defaultdict(lambda: array('i'))
+
+  for line_num, klass in enumerate(labels):
+    line_numbers[klass].append(line_num)
+
+  return line_numbers
+
+
+def _get_chunk_line_numbers_indexed_by_class(chunk):
+  # (class, line numbers) in the order classes first appear in the chunk
+  input_file_name, start, end, first_line_num = chunk
+  line_numbers = dict()
+  classes = []
+  for line_num, input_line in enumerate(read_lines(input_file_name, start, end), first_line_num):
+    klass = input_line.split(b" ", 2)[1]
+    if klass not in line_numbers:
+      line_numbers[klass] = array('i')
+      classes.append(klass)
+    line_numbers[klass].append(line_num)
+
+  return [(str(klass.decode('ascii')), line_numbers[klass]) for klass in classes]
+
+
+def get_line_numbers_indexed_by_class_in_parallel(pool, num_workers, input_file_name, chunks, line_offsets):
+  # same as get_line_numbers_indexed_by_class, classes in the same order too
+  line_numbers = defaultdict(lambda: array('i'))
+  chunk_arguments = [(input_file_name, start, end, first_line_num) for (start, end), first_line_num in zip(chunks, line_offsets)]
+  for chunk_line_numbers in imap_in_order(pool, _get_chunk_line_numbers_indexed_by_class, chunk_arguments, 2 * num_workers):
+    for klass, line_numbers_in_chunk in chunk_line_numbers:
+      line_numbers[klass].extend(line_numbers_in_chunk)
+
+  return line_numbers
+
+
+def get_total_number_of_examples(line_numbers):
   num_examples = 0
-  for examples_in_class in examples.values():
-    num_examples = num_examples + len(examples_in_class)
+  for line_numbers_in_class in line_numbers.values():
+    num_examples = num_examples + len(line_numbers_in_class)
 
   return num_examples
 
 
-def get_line_to_example_with_fold_attribute_mapping(examples, num_folds):
-  line_to_example = [None] * get_total_number_of_examples(examples)
+def get_line_to_fold_mapping(line_numbers, num_folds):
+  line_to_fold = array('i', [0]) * get_total_number_of_examples(line_numbers)
 
   # shuffle within each class
   i = -1
-  for examples_in_class in examples.values():
-    random.shuffle(examples_in_class)
+  for line_numbers_in_class in line_numbers.values():
+    random.shuffle(line_numbers_in_class)
 
     # assign fold number to examples in each class
-    for example in examples_in_class:
+    for line_num in line_numbers_in_class:
       i = i + 1
-      example.fold = i % num_folds + 1
-      line_to_example[example.line_num] = example
+      line_to_fold[line_num] = i % num_folds + 1
 
-  return line_to_example
+  return line_to_fold
 
 
-def get_folded_file_name(input_file_name, fold_id):
-  return input_file_name + '.fold_' + str(fold_id)
+def read_line_to_fold_mapping(folds_file_name):
+  line_to_fold = array('i')
+  with open(folds_file_name) as folds_file:
+    for folds_line in folds_file:
+      line_to_fold.append(int(folds_line.rsplit('\t', 1)[1]))
 
+  return line_to_fold
 
-def get_fold_folder_name(input_file_name, train_folds):
-  return input_file_name + "_model_" + '_'.join([str(fold_id) for fold_id in train_folds])
 
+def _get_chunk_folds_lines(chunk):
+  input_file_name, start, end, line_to_fold = chunk
+  return b''.join(input_line.split(b" ", 1)[0] + b'\t' + str(fold_id).encode('ascii') + b'\n'
+                  for input_line, fold_id in zip(read_lines(input_file_name, start, end), line_to_fold))
 
-if __name__ == "__main__":
-  assert len(sys.argv) == 3, "need two args"
-  input_file_name = sys.argv[1]
-  num_folds = int(sys.argv[2])
-  assert num_folds > 0, "invalid num_folds"
 
-  if len(os.path.dirname(input_file_name)) > 0:
-    os.chdir(os.path.dirname(input_file_name))
+def write_folds_file_in_parallel(pool, num_workers, input_file_name, chunks, line_offsets, line_to_fold, folds_file_name):
+  chunk_arguments = [(input_file_name, start, end, line_to_fold[line_offsets[i]:line_offsets[i+1]]) for i, (start, end) in enumerate(chunks)]
+  with open(folds_file_name, 'wb') as folds_file:
+    for folds_lines in imap_in_order(pool, _get_chunk_folds_lines, chunk_arguments, 2 * num_workers):
+      folds_file.write(folds_lines)
 
-  expected_folds_filename = os.path.basename(input_file_name) + '.' + str(num_folds) + '_folds'
 
-  with open(input_file_name) as input_file:
-    examples = get_examples_indexed_by_class(input_file)
+def get_counts_indexed_by_folds(line_numbers, line_to_fold):
+  counts_indexed_by_folds = defaultdict(Counter)
+  for klass, line_numbers_in_class in line_numbers.items():
+    for line_num in line_numbers_in_class:
+      counts_indexed_by_folds[line_to_fold[line_num]][int(klass)] += 1
 
-  num_classes = len(examples)
+  return counts_indexed_by_folds
 
-  # check if folds file exists
-  if not os.path.exists(expected_folds_filename):
-    print("Folds file do not exist, creating one...")
 
-    print("Number of classes:", num_classes, file=sys.stderr)
-    print("Number of examples:", get_total_number_of_examples(examples), file=sys.stderr)
-
-    line_to_example = get_line_to_example_with_fold_attribute_mapping(examples, num_folds)
-    
-    # write to file, meanwhile, gather distribution information
-    counts_indexed_by_folds = defaultdict(Counter)
-    with open(expected_folds_filename, 'w') as folds_file:
-      for example in line_to_example:
-        folds_file.write(str(example.example_id) + '\t' + str(example.fold) + '\n')
-        counts_indexed_by_folds[example.fold][example.klass] += 1
-
-    print("Actual distribution:", counts_indexed_by_folds, file=sys.stderr)
-  else:
-    print("Using existing folds file:", expected_folds_filename, file=sys.stderr)
+def write_manifest(folder_name, train_folds, counts_indexed_by_folds, num_classes):
+  """Write what train_and_test.py would otherwise have to count itself: the
+  classes, the one-vs-all positive/negative counts, row counts and file sizes."""
+  train_counts = Counter()
+  test_counts = Counter()
+  for fold_id, counts in counts_indexed_by_folds.items():
+    if fold_id in train_folds:
+      train_counts.update(counts)
+    else:
+      test_counts.update(counts)
 
-  # start distributing examples to folds
-  folded_files = dict()
-  for fold_id in range(1, num_folds + 1):
-    folded_files[str(fold_id)] = open(get_folded_file_name(input_file_name, fold_id), 'w')
+  classes = list(range(1, num_classes + 1))
+  num_train_rows = sum(train_counts.values())
+  file_sizes = dict()
+  for filename in os.listdir(folder_name):
+    if os.path.isfile(os.path.join(folder_name, filename)) and filename != MANIFEST_FILENAME:
+      file_sizes[filename] = os.path.getsize(os.path.join(folder_name, filename))
 
-  with open(expected_folds_filename) as folds_file, open(input_file_name) as input_file:
-    for folds_line, input_line in zip(folds_file, input_file):
-      id_in_folds, target_fold = folds_line.strip().split('\t')
-      id_in_input = input_line.split(' ')[0]
-      rest_of_input_line = ' '.join(input_line.split(' ')[1:])
+  manifest = {
+    'classes': classes,
+    'num_train_rows': num_train_rows,
+    'num_test_rows': sum(test_counts.values()),
+    'num_positive': dict((class_id, train_counts[class_id]) for class_id in classes),
+    'num_negative': dict((class_id, num_train_rows - train_counts[class_id]) for class_id in classes),
+    'test_class_counts': dict((class_id, test_counts[class_id]) for class_id in classes),
+    'file_sizes': file_sizes,
+  }
+  with open(os.path.join(folder_name, MANIFEST_FILENAME), 'w') as manifest_file:
+    json.dump(manifest, manifest_file, indent=2, sort_keys=True)
 
-      assert id_in_folds == id_in_input
 
-      folded_files[target_fold].write(rest_of_input_line)
+def get_folded_file_name(input_file_name, fold_id):
+  return input_file_name + '.fold_' + str(fold_id)
 
-  for fold_id in range(1, num_folds + 1):
-    folded_files[str(fold_id)].close()
+
+def get_fold_folder_name(input_file_name, train_folds):
+  return input_file_name + "_model_" + '_'.join([str(fold_id) for fold_id in train_folds])
+
+
+def create_fold_folder(folder_name):
+  # files of a layout prepared earlier would be trained alongside this one's
+  print("Creating folds folder:", folder_name, file=sys.stderr)
+  if not os.path.isdir(folder_name):
+    os.makedirs(folder_name)
+    return
+
+  print("Folds folder already exists, removing its training files.", file=sys.stderr)
+  for filename in os.listdir(folder_name):
+    if filename == 'train' or filename.startswith('train.class_') or filename.startswith('train.pair_') or filename.startswith('labels.'):
+      os.remove(os.path.join(folder_name, filename))
+  shutil.rmtree(os.path.join(folder_name, 'test.bin'), ignore_errors=True)
+
+
+def distribute_examples_multi_pass(input_file_name, folds_file_name, num_folds, num_classes, shared_features=False, pairwise=False, dataset=None, line_to_fold=None):
+  # start distributing examples to folds; with the binary columns of the input
+  # (and its line_to_fold), each fold's lines are copied as byte ranges
+  # instead of being split into tokens
+  if dataset is not None and dataset.has_example_ids():
+    write_folded_files_from_binary(input_file_name, dataset, line_to_fold, num_folds)
+  else:
+    write_folded_files(input_file_name, folds_file_name, num_folds)
 
   # create train/test combinations
   for train_folds in itertools.combinations(range(1, num_folds+1), num_folds-1):
     folder_name = get_fold_folder_name(input_file_name, train_folds)
 
-    print("Creating folds folder:", folder_name, file=sys.stderr)
-    try:
-      os.makedirs(folder_name)
-    except OSError:
-      print("Folds folder already exists.", file=sys.stderr)
+    create_fold_folder(folder_name)
 
     # concat corresponding train & test files
     with open(os.path.join(folder_name, 'train'), 'w') as train_file:
@@ -138,8 +210,17 @@ if __name__ == "__main__":
           for input_line in input_file:
             test_file.write(input_line)
 
+    if pairwise:
+      write_pairwise_files(folder_name, num_classes, shared_features)
+      if not shared_features:
+        os.remove(train_file.name)
+      continue
+
+    if shared_features:
+      write_label_files(folder_name, num_classes)
+      continue
+
     # create one-vs-all files
-    # TODO: implement pairwise
     for class_id in range(1, num_classes + 1):
       print("Producing", class_id, "vs all files...", file=sys.stderr)
 
@@ -162,4 +243,444 @@ if __name__ == "__main__":
 
   # remove fold files to save space
   for fold_id in range(1, num_folds + 1):
-    os.remove(folded_files[str(fold_id)].name)
+    os.remove(get_folded_file_name(input_file_name, fold_id))
+
+
+def write_folded_files(input_file_name, folds_file_name, num_folds):
+  folded_files = dict()
+  for fold_id in range(1, num_folds + 1):
+    folded_files[str(fold_id)] = open(get_folded_file_name(input_file_name, fold_id), 'w')
+
+  with open(folds_file_name) as folds_file, open(input_file_name) as input_file:
+    for folds_line, input_line in zip(folds_file, input_file):
+      id_in_folds, target_fold = folds_line.strip().split('\t')
+      id_in_input = input_line.split(' ')[0]
+      rest_of_input_line = ' '.join(input_line.split(' ')[1:])
+
+      assert id_in_folds == id_in_input
+
+      folded_files[target_fold].write(rest_of_input_line)
+
+  for fold_id in range(1, num_folds + 1):
+    folded_files[str(fold_id)].close()
+
+
+def write_folded_files_from_binary(input_file_name, dataset, line_to_fold, num_folds):
+  assert len(line_to_fold) == dataset.num_rows, "folds file and input have different numbers of lines"
+
+  rows_indexed_by_fold = defaultdict(lambda: array('i'))
+  for line_num, fold_id in enumerate(line_to_fold):
+    rows_indexed_by_fold[fold_id].append(line_num)
+
+  for fold_id in range(1, num_folds + 1):
+    with open(get_folded_file_name(input_file_name, fold_id), 'wb', WRITE_BUFFER_SIZE) as folded_file:
+      dataset.copy_rows(input_file_name, rows_indexed_by_fold[fold_id], folded_file)
+
+
+def write_label_files(folder_name, num_classes):
+  # one-vs-all label vectors for the shared train file, written in one pass
+  label_files = dict()
+  for class_id in range(1, num_classes + 1):
+    label_files[class_id] = open(os.path.join(folder_name, 'labels.class_') + str(class_id), 'w', WRITE_BUFFER_SIZE)
+
+  print("Producing one-vs-all label files for", folder_name + "...", file=sys.stderr)
+
+  with open(os.path.join(folder_name, 'train')) as train_file:
+    for train_line in train_file:
+      klass = int(train_line.split(' ', 1)[0])
+
+      for class_id, label_file in label_files.items():
+        if klass == class_id:
+          label_file.write('1\n')
+        else:
+          label_file.write('-1\n')
+
+  for label_file in label_files.values():
+    label_file.close()
+
+
+def open_fold_folder_files(input_file_name, num_folds, num_classes, shared_features=False, mode='w'):
+  """Create every fold folder and open its test file, its train file (with
+  shared_features, None otherwise) and its train.class_N (or labels.class_N)
+  files.  Returns (train_folds, test_file, train_file, class_files) of each
+  folder, class_files being (class_id, file) pairs."""
+  fold_folders = []
+  for train_folds in itertools.combinations(range(1, num_folds+1), num_folds-1):
+    folder_name = get_fold_folder_name(input_file_name, train_folds)
+
+    create_fold_folder(folder_name)
+
+    test_file = open(os.path.join(folder_name, 'test'), mode, WRITE_BUFFER_SIZE)
+
+    if shared_features:
+      train_file = open(os.path.join(folder_name, 'train'), mode, WRITE_BUFFER_SIZE)
+      class_file_prefix = 'labels.class_'
+    else:
+      train_file = None
+      class_file_prefix = 'train.class_'
+
+    class_files = []
+    for class_id in range(1, num_classes + 1):
+      class_files.append((class_id, open(os.path.join(folder_name, class_file_prefix) + str(class_id), mode, WRITE_BUFFER_SIZE)))
+
+    fold_folders.append((train_folds, test_file, train_file, class_files))
+
+  return fold_folders
+
+
+def close_fold_folder_files(fold_folders):
+  for _, test_file, train_file, class_files in fold_folders:
+    test_file.close()
+    if train_file is not None:
+      train_file.close()
+    for _, class_file in class_files:
+      class_file.close()
+
+
+def write_pairwise_files(folder_name, num_classes, shared_features=False):
+  """One file per pair of classes I < J: train.pair_I_J with the training
+  lines of I labeled 1 and those of J labeled -1, or with shared_features,
+  labels.pair_I_J with a label per line of train, 0 for lines of neither
+  class.  One pass over train per class keeps at most num_classes files open."""
+  for class_id in range(1, num_classes):
+    print("Producing", class_id, "vs each other class files...", file=sys.stderr)
+
+    pair_files = dict()
+    for other_class_id in range(class_id + 1, num_classes + 1):
+      pair_filename = ('labels.pair_' if shared_features else 'train.pair_') + str(class_id) + '_' + str(other_class_id)
+      pair_files[other_class_id] = open(os.path.join(folder_name, pair_filename), 'w', WRITE_BUFFER_SIZE)
+
+    with open(os.path.join(folder_name, 'train')) as train_file:
+      for train_line in train_file:
+        klass, separator, features = train_line.partition(' ')
+        klass = int(klass)
+
+        if shared_features:
+          for other_class_id, pair_file in pair_files.items():
+            if klass == class_id:
+              pair_file.write('1\n')
+            elif klass == other_class_id:
+              pair_file.write('-1\n')
+            else:
+              pair_file.write('0\n')
+        elif klass == class_id:
+          positive_line = '1' + separator + features
+          for pair_file in pair_files.values():
+            pair_file.write(positive_line)
+        elif klass in pair_files:
+          pair_files[klass].write('-1' + separator + features)
+
+    for pair_file in pair_files.values():
+      pair_file.close()
+
+
+def distribute_examples_single_pass(input_file_name, folds_file_name, num_folds, num_classes, shared_features=False):
+  # open every output file up front, then route each input line straight into
+  # the test file / train.class_N files of every fold folder it belongs to
+  # (or its train file and labels.class_N files with shared_features)
+  test_files_indexed_by_fold = defaultdict(list)
+  train_files_indexed_by_fold = defaultdict(list)
+
+  fold_folders = open_fold_folder_files(input_file_name, num_folds, num_classes, shared_features)
+  for train_folds, test_file, train_file, class_files in fold_folders:
+    for fold_id in set(range(1, num_folds+1)) - set(train_folds):
+      test_files_indexed_by_fold[str(fold_id)].append(test_file)
+    for fold_id in train_folds:
+      train_files_indexed_by_fold[str(fold_id)].append((train_file, class_files))
+  num_opened_files = sum(len(class_files) + (2 if train_file is not None else 1) for _, _, train_file, class_files in fold_folders)
+
+  print("Distributing", input_file_name, "to", num_opened_files, "files in a single pass...", file=sys.stderr)
+
+  with open(folds_file_name) as folds_file, open(input_file_name) as input_file:
+    for folds_line, input_line in zip(folds_file, input_file):
+      id_in_folds, target_fold = folds_line.strip().split('\t')
+      id_in_input, _, rest_of_input_line = input_line.partition(' ')
+
+      assert id_in_folds == id_in_input
+
+      for test_file in test_files_indexed_by_fold[target_fold]:
+        test_file.write(rest_of_input_line)
+
+      if len(train_files_indexed_by_fold[target_fold]) == 0:
+        continue
+
+      # one-vs-all lines only differ in their first token
+      klass, separator, features = rest_of_input_line.partition(' ')
+      klass = int(klass)
+      if shared_features:
+        positive_line = '1\n'
+        negative_line = '-1\n'
+      else:
+        positive_line = '1' + separator + features
+        negative_line = '-1' + separator + features
+
+      for train_file, class_files in train_files_indexed_by_fold[target_fold]:
+        if train_file is not None:
+          train_file.write(rest_of_input_line)
+
+        for class_id, class_file in class_files:
+          if klass == class_id:
+            class_file.write(positive_line)
+          else:
+            class_file.write(negative_line)
+
+  close_fold_folder_files(fold_folders)
+
+
+def _get_fold_folder_layout(all_train_folds, num_folds):
+  test_folders_indexed_by_fold = defaultdict(list)
+  train_folders_indexed_by_fold = defaultdict(list)
+  for folder_id, train_folds in enumerate(all_train_folds):
+    for fold_id in set(range(1, num_folds+1)) - set(train_folds):
+      test_folders_indexed_by_fold[fold_id].append(folder_id)
+    for fold_id in train_folds:
+      train_folders_indexed_by_fold[fold_id].append(folder_id)
+
+  return test_folders_indexed_by_fold, train_folders_indexed_by_fold
+
+
+def _route_chunk(chunk):
+  """A chunk's lines laid out the way distribute_examples_single_pass writes
+  them: for each fold folder, the lines of its test file, train file (with
+  shared_features) and class files, in input order."""
+  input_file_name, start, end, line_to_fold, all_train_folds, num_folds, num_classes, shared_features = chunk[:8]
+  test_folders_indexed_by_fold, train_folders_indexed_by_fold = _get_fold_folder_layout(all_train_folds, num_folds)
+
+  test_lines = [[] for _ in all_train_folds]
+  train_lines = [[] for _ in all_train_folds]
+  class_lines = [[[] for _ in range(num_classes)] for _ in all_train_folds]
+
+  for input_line, fold_id in zip(read_lines(input_file_name, start, end), line_to_fold):
+    _, _, rest_of_input_line = input_line.partition(b' ')
+
+    for folder_id in test_folders_indexed_by_fold[fold_id]:
+      test_lines[folder_id].append(rest_of_input_line)
+
+    if len(train_folders_indexed_by_fold[fold_id]) == 0:
+      continue
+
+    klass, separator, features = rest_of_input_line.partition(b' ')
+    klass = int(klass)
+    if shared_features:
+      positive_line = b'1\n'
+      negative_line = b'-1\n'
+    else:
+      positive_line = b'1' + separator + features
+      negative_line = b'-1' + separator + features
+
+    for folder_id in train_folders_indexed_by_fold[fold_id]:
+      if shared_features:
+        train_lines[folder_id].append(rest_of_input_line)
+
+      for class_id, lines in enumerate(class_lines[folder_id], 1):
+        if klass == class_id:
+          lines.append(positive_line)
+        else:
+          lines.append(negative_line)
+
+  routed_lines = []
+  for folder_id in range(len(all_train_folds)):
+    routed_lines.append(b''.join(test_lines[folder_id]))
+    if shared_features:
+      routed_lines.append(b''.join(train_lines[folder_id]))
+    routed_lines.extend(b''.join(lines) for lines in class_lines[folder_id])
+  return routed_lines
+
+
+def _get_chunk_routed_sizes(chunk):
+  # the sizes of what _route_chunk returns, from per-fold sums rather than the lines
+  input_file_name, start, end, line_to_fold, all_train_folds, num_folds, num_classes, shared_features = chunk
+  test_folders_indexed_by_fold, train_folders_indexed_by_fold = _get_fold_folder_layout(all_train_folds, num_folds)
+
+  rest_sizes = Counter()
+  feature_sizes = Counter()
+  num_lines = Counter()
+  num_positives = defaultdict(Counter)
+  for input_line, fold_id in zip(read_lines(input_file_name, start, end), line_to_fold):
+    _, _, rest_of_input_line = input_line.partition(b' ')
+    rest_sizes[fold_id] += len(rest_of_input_line)
+
+    if len(train_folders_indexed_by_fold[fold_id]) == 0:
+      continue
+
+    klass, separator, features = rest_of_input_line.partition(b' ')
+    feature_sizes[fold_id] += len(separator) + len(features)
+    num_lines[fold_id] += 1
+    num_positives[fold_id][int(klass)] += 1
+
+  routed_sizes = []
+  for train_folds in all_train_folds:
+    routed_sizes.append(sum(rest_sizes[fold_id] for fold_id in set(range(1, num_folds+1)) - set(train_folds)))
+    if shared_features:
+      routed_sizes.append(sum(rest_sizes[fold_id] for fold_id in train_folds))
+
+    num_train_lines = sum(num_lines[fold_id] for fold_id in train_folds)
+    train_feature_size = sum(feature_sizes[fold_id] for fold_id in train_folds)
+    for class_id in range(1, num_classes + 1):
+      num_positive = sum(num_positives[fold_id][class_id] for fold_id in train_folds)
+      if shared_features:
+        # '1\n' or '-1\n'
+        routed_sizes.append(2 * num_positive + 3 * (num_train_lines - num_positive))
+      else:
+        # '1' or '-1' in front of the features
+        routed_sizes.append(train_feature_size + num_positive + 2 * (num_train_lines - num_positive))
+
+  return routed_sizes
+
+
+def _write_routed_chunk(chunk):
+  filenames, offsets = chunk[8:]
+  for filename, offset, data in zip(filenames, offsets, _route_chunk(chunk)):
+    if len(data) == 0:
+      continue
+
+    output_fd = os.open(filename, os.O_WRONLY)
+    try:
+      os.lseek(output_fd, offset, os.SEEK_SET)
+      while len(data) > 0:
+        data = data[os.write(output_fd, data):]
+    finally:
+      os.close(output_fd)
+
+
+def distribute_examples_in_parallel(pool, num_workers, input_file_name, line_to_fold, num_folds, num_classes, shared_features=False):
+  # the output is the same as distribute_examples_single_pass's.  Workers first
+  # work out how many bytes each chunk adds to each file, then write their
+  # chunk's lines right where they go, so that no lines go between processes.
+  # A chunk's lines take up to num_folds * (num_classes + 1) times as much
+  # memory once laid out, so chunks are smaller than for the other passes
+  chunks = get_chunks(input_file_name, max(MIN_ROUTING_CHUNK_SIZE, CHUNK_SIZE // (num_folds * (num_classes + 1))))
+  line_offsets = get_line_offsets(pool, input_file_name, chunks)
+  assert line_offsets[-1] == len(line_to_fold), "folds file and input have different numbers of lines"
+
+  fold_folders = open_fold_folder_files(input_file_name, num_folds, num_classes, shared_features, 'wb')
+  close_fold_folder_files(fold_folders)
+  all_train_folds = [train_folds for train_folds, _, _, _ in fold_folders]
+  filenames = []
+  for _, test_file, train_file, class_files in fold_folders:
+    filenames.append(test_file.name)
+    if train_file is not None:
+      filenames.append(train_file.name)
+    filenames.extend(class_file.name for _, class_file in class_files)
+
+  print("Distributing", input_file_name, "to", len(filenames), "files in", len(chunks), "chunks with", num_workers, "workers...", file=sys.stderr)
+
+  def get_chunk_arguments():
+    for i, (start, end) in enumerate(chunks):
+      yield (input_file_name, start, end, line_to_fold[line_offsets[i]:line_offsets[i+1]], all_train_folds, num_folds, num_classes, shared_features)
+
+  chunk_offsets = []
+  file_sizes = [0] * len(filenames)
+  for routed_sizes in imap_in_order(pool, _get_chunk_routed_sizes, get_chunk_arguments(), 2 * num_workers):
+    chunk_offsets.append(list(file_sizes))
+    file_sizes = [file_size + routed_size for file_size, routed_size in zip(file_sizes, routed_sizes)]
+
+  for _ in imap_in_order(pool, _write_routed_chunk, (chunk_arguments + (filenames, offsets) for chunk_arguments, offsets in zip(get_chunk_arguments(), chunk_offsets)), 2 * num_workers):
+    pass
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('input_file_name')
+  parser.add_argument('num_folds', type=int)
+  parser.add_argument('--single-pass', action='store_true',
+                      help="write all fold folders in one pass over the input, without intermediate .fold_N and train files "
+                           "(needs num_folds * (num_classes + 1) open files)")
+  parser.add_argument('--shared-features', action='store_true',
+                      help="store the training rows once per fold folder as train, plus one labels.class_N file of "
+                           "+1/-1 labels per class, instead of a full train.class_N copy per class")
+  parser.add_argument('--binary', action='store_true',
+                      help="convert the input to binary columns (see convert_to_binary.py) if not done yet, "
+                           "and write a labels column next to each fold folder's test file")
+  parser.add_argument('--seed', type=int, default=None,
+                      help="seed for the stratified shuffle when creating a new folds file")
+  parser.add_argument('--pairwise', action='store_true',
+                      help="write one training file (or labels file, with --shared-features) per pair of classes, "
+                           "for one-vs-one models, instead of one per class")
+  parser.add_argument('--workers', type=int, default=1,
+                      help="with more than 1, read the input in chunks and process them in this many processes; "
+                           "fold folders come out the same as with --single-pass")
+  args = parser.parse_args()
+
+  input_file_name = args.input_file_name
+  num_folds = args.num_folds
+  assert num_folds > 0, "invalid num_folds"
+  if args.pairwise and (args.single_pass or args.workers > 1):
+    parser.error("--pairwise would need a file per pair of classes open at once, so it works without --single-pass and --workers only")
+
+  if len(os.path.dirname(input_file_name)) > 0:
+    os.chdir(os.path.dirname(input_file_name))
+
+  expected_folds_filename = os.path.basename(input_file_name) + '.' + str(num_folds) + '_folds'
+
+  # label and id passes read the binary columns instead of the text when they are available
+  dataset = convert_to_binary.open_if_fresh(input_file_name)
+  if dataset is None and args.binary:
+    print("Converting", input_file_name, "to binary columns...", file=sys.stderr)
+    dataset = convert_to_binary.convert(input_file_name)
+
+  pool = None
+  if args.workers > 1:
+    pool = Pool(processes=args.workers)
+    chunks = get_chunks(input_file_name)
+    line_offsets = get_line_offsets(pool, input_file_name, chunks)
+
+  if dataset is not None:
+    line_numbers = get_line_numbers_indexed_by_class(str(label) for label in dataset.labels())
+  elif pool is not None:
+    line_numbers = get_line_numbers_indexed_by_class_in_parallel(pool, args.workers, input_file_name, chunks, line_offsets)
+  else:
+    with open(input_file_name) as input_file:
+      line_numbers = get_line_numbers_indexed_by_class(get_labels(input_file))
+
+  num_classes = len(line_numbers)
+
+  # check if folds file exists
+  if not os.path.exists(expected_folds_filename):
+    print("Folds file do not exist, creating one...")
+
+    print("Number of classes:", num_classes, file=sys.stderr)
+    print("Number of examples:", get_total_number_of_examples(line_numbers), file=sys.stderr)
+
+    if args.seed is not None:
+      random.seed(args.seed)
+
+    line_to_fold = get_line_to_fold_mapping(line_numbers, num_folds)
+
+    # write to file, taking example ids from the input again rather than keeping them in memory
+    # (datasets converted with --labels-only or --no-ids have none)
+    ids_dataset = dataset if dataset is not None and dataset.has_example_ids() else None
+    if ids_dataset is None and pool is not None:
+      write_folds_file_in_parallel(pool, args.workers, input_file_name, chunks, line_offsets, line_to_fold, expected_folds_filename)
+    else:
+      with open(expected_folds_filename, 'w') as folds_file, open(input_file_name) as input_file:
+        if ids_dataset is not None:
+          example_ids = ids_dataset.example_ids()
+        else:
+          example_ids = get_example_ids(input_file)
+
+        for line_num, example_id in enumerate(example_ids):
+          folds_file.write(example_id + '\t' + str(line_to_fold[line_num]) + '\n')
+  else:
+    print("Using existing folds file:", expected_folds_filename, file=sys.stderr)
+    line_to_fold = read_line_to_fold_mapping(expected_folds_filename)
+
+  # gather distribution information
+  counts_indexed_by_folds = get_counts_indexed_by_folds(line_numbers, line_to_fold)
+  print("Actual distribution:", counts_indexed_by_folds, file=sys.stderr)
+
+  if pool is not None:
+    distribute_examples_in_parallel(pool, args.workers, input_file_name, line_to_fold, num_folds, num_classes, args.shared_features)
+    pool.close()
+    pool.join()
+  elif args.single_pass:
+    distribute_examples_single_pass(input_file_name, expected_folds_filename, num_folds, num_classes, args.shared_features)
+  else:
+    distribute_examples_multi_pass(input_file_name, expected_folds_filename, num_folds, num_classes, args.shared_features, args.pairwise, dataset, line_to_fold)
+
+  for train_folds in itertools.combinations(range(1, num_folds+1), num_folds-1):
+    folder_name = get_fold_folder_name(input_file_name, train_folds)
+    if args.binary:
+      convert_to_binary.convert(os.path.join(folder_name, 'test'), has_ids=False, labels_only=True)
+
+    write_manifest(folder_name, train_folds, counts_indexed_by_folds, num_classes)
@@ -3,16 +3,25 @@ import atexit
 import os
 import sys
 import re
+import time
+import argparse
+import math
+import json
 from server_adapters.localhost import LocalRunner
 from server_adapters.ssh import SSHRunner
+from scheduler import Scheduler
+from standalone_scripts.train_and_test import get_confusion_matrix, get_report
 from collections import namedtuple, defaultdict, Counter
-from multiprocessing import JoinableQueue, Process, Manager, log_to_stderr
+from multiprocessing import log_to_stderr
+from multiprocessing.pool import ThreadPool
 import logging
 from prettytable import PrettyTable
 
 
 Job = namedtuple('Job', ['directory', 'svm_params'])
 
+JOURNAL_FILENAME = 'results.jsonl'
+
 
 folder_name_pattern = re.compile(r'_model(?P<fold_numbers>(?:_\d+)+)$')
 train_filename_pattern = re.compile(r'^train\.class_(?P<class>\d+)$')
@@ -36,6 +45,49 @@ def get_fold_numbers(folder_name):
     return False
 
 
+def count_models(folder_name):
+  # one per class, or per pair of classes
+  return sum(1 for filename in os.listdir(folder_name) if filename.startswith('train.') or filename.startswith('labels.'))
+
+
+def bootstrap_servers(servers, timeout, logger):
+  """Bootstrap all servers at once and yield each one as soon as it is ready.
+  Servers whose bootstrap fails or takes longer than timeout seconds are left
+  out."""
+  if len(servers) == 0:
+    return
+
+  pool = ThreadPool(len(servers))
+  pending = dict((pool.apply_async(server.bootstrap), server) for server in servers)
+  deadline = time.time() + timeout
+
+  while len(pending) > 0:
+    # servers that got ready by the deadline are still used
+    timed_out = time.time() > deadline
+
+    for bootstrap_result, server in list(pending.items()):
+      if not bootstrap_result.ready():
+        continue
+
+      del pending[bootstrap_result]
+      try:
+        bootstrap_result.get()
+      except Exception as e:
+        logger.error("Not using " + str(server) + ", bootstrap failed: " + repr(e))
+      else:
+        yield server
+
+    if timed_out:
+      for server in pending.values():
+        logger.error("Not using " + str(server) + ", bootstrap took longer than " + str(timeout) + " seconds.")
+      break
+
+    time.sleep(0.1)
+
+  # don't wait for bootstraps that timed out
+  pool.close()
+
+
 def write_results_file(results):
   with open('results', 'w') as results_file:
     for job in results.keys():
@@ -44,52 +96,179 @@ def write_results_file(results):
       results_file.write(str(results[job]) + '\n\n')
 
 
-def print_table(results):
-  # build a list of all svm_params
-  # each being one table
-  results_tables = defaultdict(Counter)
+def get_aggregated_reports(results):
+  """Score each svm_params on the confusion matrices of all its completed folds
+  summed together rather than on averaged ratios.  Returns the reports and the
+  number of completed and of all folds, each indexed by svm_params."""
+  pair_counts = defaultdict(Counter)
+  num_exps = Counter()
+  num_completed_exps = Counter()
 
-  # sum f1, precision, recall
   for job in results.keys():
-    this_results_table = results_tables[job.svm_params]
+    num_exps[job.svm_params] += 1
 
-    if 'classes' not in this_results_table:
-      this_results_table['classes'] = defaultdict(Counter)
+    if 'status' not in results[job]:
+      num_completed_exps[job.svm_params] += 1
 
-    this_results_table['num_exps'] += 1
+      confusion = results[job]['confusion']
+      for actual, row in zip(confusion['classes'], confusion['matrix']):
+        for predicted, count in zip(confusion['classes'], row):
+          pair_counts[job.svm_params][(actual, predicted)] += count
 
-    if not ('status' in results[job] and results[job]['status'] == 'waiting'):
-      this_results_table['num_completed_exps'] += 1
+  reports = dict((svm_params, get_report(get_confusion_matrix(pair_counts[svm_params]))) for svm_params in num_exps.keys())
+  return reports, num_completed_exps, num_exps
 
-      # sum f1, precision and recall for each class
-      for class_id, stats in results[job].items():
-        for stats_type, stats_value in stats.items():
-          this_results_table['classes'][class_id][stats_type] += stats_value
 
-  # divide by # of completed to get average
-  for experiment_name in results_tables.keys():
-    experiment_result = results_tables[experiment_name]
-    for class_id, class_stats in experiment_result['classes'].items():
-      for stats_type, stats_value in class_stats.items():
-        experiment_result['classes'][class_id][stats_type] /= experiment_result['num_completed_exps']
+def print_table(results):
+  # one table per svm_params
+  reports, num_completed_exps, num_exps = get_aggregated_reports(results)
 
-  # TODO: sorting by class
   # TODO: stdev
 
   # build tables
-  for table_name, result_table in results_tables.items():
+  for table_name, report in reports.items():
     pretty_table = PrettyTable(["Class", "F1", "Precision", "Recall"])
 
-    for class_id, stats in result_table['classes'].items():
+    for class_id in sorted(report['classes'].keys()):
+      stats = report['classes'][class_id]
       pretty_table.add_row([class_id, stats['f1'], stats['precision'], stats['recall']])
 
+    for average in ('micro', 'macro'):
+      stats = report[average]
+      pretty_table.add_row([average, stats['f1'], stats['precision'], stats['recall']])
+
     print(table_name)
     print("="*len(table_name), end='\n\n')
+    print(str(num_completed_exps[table_name]) + " of " + str(num_exps[table_name]) + " folds completed", end='\n\n')
     print(pretty_table, end='\n\n')
 
 
+def get_timings(results):
+  """(job, timing) of every phase timed by the runners and train_and_test.py.
+  Jobs run in one batch share the runner's phases, which are listed once."""
+  timings = []
+  seen = set()
+  for job in sorted(results.keys()):
+    for timing in results[job].get('timings', []):
+      key = (timing['host'], timing['name'], timing['detail'], timing['start'], timing['thread'])
+      if key not in seen:
+        seen.add(key)
+        timings.append((job, timing))
+
+  return timings
+
+
+def print_timing_summary(results):
+  durations = defaultdict(list)
+  for _, timing in get_timings(results):
+    durations[(timing['host'], timing['name'])].append(timing['duration'])
+
+  if len(durations) == 0:
+    return
+
+  pretty_table = PrettyTable(["Host", "Phase", "Count", "Total (s)", "Mean (s)", "Max (s)"])
+  for (host, name), phase_durations in sorted(durations.items()):
+    pretty_table.add_row([host, name, len(phase_durations), round(sum(phase_durations), 3),
+                          round(sum(phase_durations) / len(phase_durations), 3), round(max(phase_durations), 3)])
+
+  print("Timings")
+  print("="*len("Timings"), end='\n\n')
+  print(pretty_table, end='\n\n')
+
+
+def write_trace(results, trace_filename):
+  """Write the timings as Chrome's trace event format, which chrome://tracing
+  and Perfetto open: one process per host, one thread per runner slot or
+  train_and_test.py worker."""
+  pids = {}
+  tids = {}
+  events = []
+  for job, timing in get_timings(results):
+    pid = pids.setdefault(timing['host'], len(pids) + 1)
+    tid = tids.setdefault((timing['host'], timing['thread']), len(tids) + 1)
+    name = timing['name'] if timing['detail'] is None else timing['name'] + ' ' + timing['detail']
+    events.append({'name': name, 'cat': timing['name'], 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': int(timing['start'] * 1e6), 'dur': int(timing['duration'] * 1e6),
+                   'args': {'directory': job.directory, 'svm_params': job.svm_params}})
+
+  for host, pid in pids.items():
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': host}})
+  for (host, thread), tid in tids.items():
+    events.append({'name': 'thread_name', 'ph': 'M', 'pid': pids[host], 'tid': tid, 'args': {'name': thread}})
+
+  with open(trace_filename, 'w') as trace_file:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+def read_journal(journal_filename):
+  """Results of the jobs an earlier run completed, from the journal the
+  scheduler appends to.  Failed jobs are left out so that they run again."""
+  results = dict()
+  if not os.path.exists(journal_filename):
+    return results
+
+  with open(journal_filename) as journal_file:
+    for journal_line in journal_file:
+      try:
+        entry = json.loads(journal_line)
+      except ValueError:  # cut short by a crash
+        continue
+      results[Job(**dict((field, entry[field]) for field in Job._fields))] = entry['result']
+
+  return dict((job, result) for job, result in results.items() if 'status' not in result)
+
+
+def submit_jobs(scheduler, svm_params_list, experiment_folders, completed_results):
+  for svm_params in svm_params_list:
+    for experiment_folder in experiment_folders:
+      job = Job(directory=experiment_folder, svm_params=svm_params)
+      if job in completed_results:
+        scheduler.restore(job, completed_results[job])
+      else:
+        scheduler.submit(job)
+
+
+def promote(results, svm_params_list, halving_rate):
+  """The best 1/halving_rate of svm_params_list (at least one) by macro F1 on
+  the folds they completed so far."""
+  reports, _, _ = get_aggregated_reports(results)
+  ranking = sorted(svm_params_list, key=lambda svm_params: reports[svm_params]['macro']['f1'], reverse=True)
+  return ranking[:max(1, int(math.ceil(len(svm_params_list) / halving_rate)))]
+
+
 if __name__ == "__main__":
-  os.chdir(sys.argv[1])
+  parser = argparse.ArgumentParser()
+  parser.add_argument('experiment_directory')
+  parser.add_argument('--bootstrap-timeout', type=float, default=600,
+                      help="seconds a server may take to get ready before it is left out")
+  parser.add_argument('--threshold', type=float, default=None,
+                      help="count examples whose best one-vs-all score is not above this as unclassified")
+  parser.add_argument('--auto-weight', action='store_true',
+                      help="have svm_learn weigh positive examples of each class by its negative/positive ratio (-j)")
+  parser.add_argument('--no-resume', action='store_true',
+                      help="run every job again instead of skipping those completed in " + JOURNAL_FILENAME)
+  parser.add_argument('--job-timeout', type=float, default=None,
+                      help="seconds after which a job is given up on and queued again")
+  parser.add_argument('--max-attempts', type=int, default=3,
+                      help="times a job may fail or time out before it is recorded as failed")
+  parser.add_argument('--quarantine-after', type=int, default=3,
+                      help="failures in a row after which a server gets no more jobs")
+  parser.add_argument('--no-speculation', action='store_true',
+                      help="don't run backup copies of slow jobs on servers that ran out of jobs")
+  parser.add_argument('--successive-halving', action='store_true',
+                      help="run every svm_params on --initial-folds folds only, then repeatedly keep the best "
+                           "1/--halving-rate of them and run those on --halving-rate times as many folds")
+  parser.add_argument('--initial-folds', type=int, default=1,
+                      help="folds to run every svm_params on with --successive-halving")
+  parser.add_argument('--halving-rate', type=int, default=3,
+                      help="with --successive-halving, keep 1/this of the svm_params and multiply their folds by this each round")
+  parser.add_argument('--probe-interval', type=float, default=60,
+                      help="seconds between probes of the servers' cores, load and free memory and disk, which size their slots and workers")
+  parser.add_argument('--trace', default=None,
+                      help="write how long each phase of each job took to this file, in the Chrome trace format")
+  args = parser.parse_args()
+
+  os.chdir(args.experiment_directory)
 
   # list experiment folder names
   experiment_folders = []
@@ -97,26 +276,34 @@ if __name__ == "__main__":
     if os.path.isdir(filename) and get_fold_numbers(filename):
       print("Using fold combination:", filename, get_fold_numbers(filename), file=sys.stderr)
       experiment_folders.append(filename)
-  
+  experiment_folders.sort()
 
   logger = log_to_stderr()
   logger.setLevel(logging.INFO)
 
+  # servers size their workers after the models a job trains
+  models_per_job = None
+  if len(experiment_folders) > 0:
+    models_per_job = count_models(experiment_folders[0])
+
   # read available server lists
   servers_list = []
   with open("servers_list") as servers_file:
     for server_line in servers_file:
-      if server_line.startswith('#'):
+      if server_line.startswith('#') or len(server_line.strip()) == 0:
         continue
 
-      hostname_and_directory = server_line.strip()
-      hostname, directory = hostname_and_directory.split(':')
+      # user@hostname:directory, optionally followed by runner options as key=value
+      server_fields = server_line.split()
+      hostname, directory = server_fields[0].split(':')
+      server_options = dict(server_field.split('=', 1) for server_field in server_fields[1:])
+      server_options.setdefault('models_per_job', models_per_job)
 
       if hostname == 'localhost':
-        servers_list.append(LocalRunner(directory))
+        servers_list.append(LocalRunner(directory, logger=logger, threshold=args.threshold, auto_weight=args.auto_weight, **server_options))
       else:
         username, hostname = hostname.split('@')
-        servers_list.append(SSHRunner(username, hostname, directory, logger=logger))
+        servers_list.append(SSHRunner(username, hostname, directory, logger=logger, threshold=args.threshold, auto_weight=args.auto_weight, **server_options))
 
   # read svm params list
   svm_params_list = []
@@ -128,24 +315,53 @@ if __name__ == "__main__":
     svm_params_list.append("")
 
 
-  manager = Manager()
-  results = manager.dict()
+  # every finished job goes to the journal right away; jobs it has results for
+  # are not run again
+  if args.no_resume and os.path.exists(JOURNAL_FILENAME):
+    os.remove(JOURNAL_FILENAME)
+  completed_results = read_journal(JOURNAL_FILENAME)
+  if len(completed_results) > 0:
+    logger.info("Resuming: " + str(len(completed_results)) + " job(s) completed in " + JOURNAL_FILENAME + " will not run again.")
 
-  # enqueue jobs
-  job_queue = JoinableQueue()
-  for svm_params in svm_params_list:
-    for experiment_folder in experiment_folders:
-      job = Job(directory=experiment_folder, svm_params=svm_params)
-      job_queue.put(job)
-      results[job] = {'status': 'waiting'}
+  scheduler = Scheduler(logger, journal_filename=JOURNAL_FILENAME, job_timeout=args.job_timeout, max_attempts=args.max_attempts,
+                        quarantine_after=args.quarantine_after, speculate=not args.no_speculation,
+                        probe_interval=args.probe_interval)
+
+  # enqueue jobs; successive halving starts with every svm_params on a few folds
+  if args.successive_halving:
+    assert args.initial_folds > 0 and args.halving_rate > 1, "invalid --initial-folds or --halving-rate"
+    num_folds = min(args.initial_folds, len(experiment_folders))
+  else:
+    num_folds = len(experiment_folders)
+
+  submit_jobs(scheduler, svm_params_list, experiment_folders[:num_folds], completed_results)
+
+  # servers start taking jobs as soon as they are ready; their runners work in
+  # threads of this process so that they keep the connections opened while bootstrapping
+  num_servers = 0
+  for server in bootstrap_servers(servers_list, args.bootstrap_timeout, logger):
+    scheduler.add_server(server)
+    num_servers += 1
+
+  if num_servers == 0:
+    logger.critical("No server is ready to run experiments.")
+    sys.exit(1)
+
+  scheduler.wait()
+
+  while num_folds < len(experiment_folders):
+    svm_params_list = promote(scheduler.results, svm_params_list, args.halving_rate)
+    new_num_folds = min(len(experiment_folders), num_folds * args.halving_rate)
+    logger.info("Running the best " + str(len(svm_params_list)) + " svm_params on " + str(new_num_folds) + " folds: " + ', '.join(svm_params_list))
 
-  # ask servers to grab jobs
-  for server in servers_list:
-    t = Process(target=server.grab_jobs, args=(job_queue, results))
-    t.daemon = True
-    t.start()
+    submit_jobs(scheduler, svm_params_list, experiment_folders[num_folds:new_num_folds], completed_results)
+    num_folds = new_num_folds
+    scheduler.wait()
 
-  job_queue.join()
+  write_results_file(scheduler.results)
+  print_table(scheduler.results)
+  print_timing_summary(scheduler.results)
 
-  write_results_file(results)
-  print_table(results)
+  if args.trace is not None:
+    write_trace(scheduler.results, args.trace)
+    logger.info("Wrote the timings of every job to " + args.trace + '.')
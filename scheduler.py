@@ -0,0 +1,357 @@
+from __future__ import print_function
+import os
+import json
+import time
+import threading
+import traceback
+from collections import deque, defaultdict, OrderedDict, Counter
+
+
+class Scheduler(object):
+  """Hands queued jobs to servers, keeping up to server.slots jobs running on
+  each server at once.  Everything lives in this process: servers work in
+  threads and results go to a plain dict.
+
+  Jobs are placed where their fold folder already is: a server gets jobs for
+  folders it holds first, then folders no server holds yet, and only takes
+  over folders held elsewhere when it would otherwise sit idle.  Servers that
+  don't need folders transferred count as holding none.
+
+  A job that fails or runs longer than job_timeout seconds is queued again,
+  preferably for another server, until it has failed max_attempts times.  A
+  server that fails quarantine_after times in a row gets no more jobs.  With
+  speculate, servers that run out of queued jobs run backup copies of jobs
+  running for longer than usual elsewhere; the first result wins.
+
+  Finished jobs are appended to journal_filename as they finish, one JSON
+  object per line, so that a crash doesn't lose them.
+
+  With probe_interval, every server's capacity is probed again that often,
+  and jobs are handed out to as many slots as the server has now."""
+
+  def __init__(self, logger, journal_filename=None, job_timeout=None, max_attempts=3, quarantine_after=3, speculate=True, probe_interval=None):
+    self.logger = logger
+    self.journal = None
+    if journal_filename is not None:
+      self.journal = open(journal_filename, 'a+')
+
+      # a line cut short by a crash must not run into the next entry
+      self.journal.seek(0, os.SEEK_END)
+      if self.journal.tell() > 0:
+        self.journal.seek(self.journal.tell() - 1)
+        if self.journal.read(1) != '\n':
+          self.journal.write('\n')
+    self.condition = threading.Condition()
+    self.pending_jobs = OrderedDict()  # directory -> deque of jobs
+    self.num_pending_jobs = 0
+    self.holders = defaultdict(set)    # directory -> servers that have (had) it
+    self.results = dict()
+    self.num_unfinished_jobs = 0
+    self.servers = []
+
+    self.job_timeout = job_timeout
+    self.max_attempts = max_attempts
+    self.quarantine_after = quarantine_after
+    self.speculate = speculate
+    self.running = defaultdict(list)   # job -> [server, start time] of each copy running
+    self.finished = set()
+    self.failures = Counter()          # job -> failed attempts
+    self.failed_on = defaultdict(set)  # job -> servers it failed on
+    self.consecutive_failures = Counter()
+    self.quarantined = set()
+    self.durations = []                # of successful attempts
+    self.slot_ids = defaultdict(set)   # server -> slots with a thread taking jobs
+
+    if job_timeout is not None:
+      watchdog = threading.Thread(target=self._watch_timeouts)
+      watchdog.daemon = True
+      watchdog.start()
+
+    self.probe_interval = probe_interval
+    if probe_interval is not None:
+      prober = threading.Thread(target=self._watch_capacity)
+      prober.daemon = True
+      prober.start()
+
+  def submit(self, job):
+    with self.condition:
+      self.pending_jobs.setdefault(job.directory, deque()).append(job)
+      self.num_pending_jobs += 1
+      self.results[job] = {'status': 'waiting'}
+      self.num_unfinished_jobs += 1
+      self.condition.notify_all()
+
+  def restore(self, job, result):
+    """Record the result of a job finished in an earlier run."""
+    with self.condition:
+      self.results[job] = result
+      self.finished.add(job)
+
+  def add_server(self, server):
+    """Start handing jobs to server right away; which folders it already
+    holds is found out meanwhile, and which results it has cached as its
+    slots take jobs."""
+    with self.condition:
+      self.servers.append(server)
+      self._start_slots(server)
+      directories = list(self.pending_jobs.keys())
+
+    if server.needs_transfer:
+      finder = threading.Thread(target=self._find_held_directories, args=(server, directories))
+      finder.daemon = True
+      finder.start()
+
+  def _find_held_directories(self, server, directories):
+    # asking may take a while (e.g. hashing folders), so not under the lock
+    for directory in directories:
+      try:
+        held = server.holds(directory)
+      except Exception as e:
+        self.logger.warning("Could not ask " + str(server) + " which folders it holds: " + repr(e))
+        return
+
+      if held:
+        with self.condition:
+          self.holders[directory].add(server)
+
+  def _start_slots(self, server):
+    # threads of slots taken away stop once they finish their job
+    for slot_id in range(server.slots):
+      if slot_id not in self.slot_ids[server]:
+        self.slot_ids[server].add(slot_id)
+        worker = threading.Thread(target=server.grab_jobs, args=(self, slot_id))
+        worker.daemon = True
+        worker.start()
+
+  def next_jobs(self, server, max_jobs, slot_id=None):
+    """Block until there are jobs for server to run; returns up to max_jobs
+    jobs, all on the same directory, or none once the server is quarantined
+    or has fewer slots than slot_id."""
+    with self.condition:
+      while True:
+        if server in self.quarantined:
+          return []
+
+        if slot_id is not None and slot_id >= server.slots:
+          self.slot_ids[server].discard(slot_id)
+          return []
+
+        directory = self._pick_directory(server)
+        if directory is not None:
+          break
+
+        backup_job = self._pick_backup_job(server)
+        if backup_job is not None:
+          self.logger.info(str(server) + " runs a backup copy of " + str(backup_job) + '.')
+          self._start(backup_job, server)
+          return [backup_job]
+
+        # wake up now and then for backups of jobs getting slow
+        self.condition.wait(1)
+
+      jobs = []
+      for job in list(self.pending_jobs[directory]):
+        if len(jobs) < max_jobs and self._may_run(job, server):
+          jobs.append(job)
+          self._unqueue(job)
+
+      if server.needs_transfer:
+        self.holders[directory].add(server)
+      for job in jobs:
+        self._start(job, server)
+      return jobs
+
+  def _may_run(self, job, server):
+    # retries go to other servers, unless every healthy one failed the job too
+    if server not in self.failed_on[job]:
+      return True
+    return all(other in self.failed_on[job] or other in self.quarantined for other in self.servers)
+
+  def _pick_directory(self, server):
+    unheld_directory = None
+    stolen_directory = None
+    for directory, directory_jobs in self.pending_jobs.items():
+      if not any(self._may_run(job, server) for job in directory_jobs):
+        continue
+
+      if server in self.holders[directory]:
+        return directory
+      if unheld_directory is None and len(self.holders[directory]) == 0:
+        unheld_directory = directory
+      if stolen_directory is None:
+        stolen_directory = directory
+
+    if unheld_directory is not None:
+      return unheld_directory
+
+    # everything left is held by other servers; steal rather than go idle
+    return stolen_directory
+
+  def _pick_backup_job(self, server):
+    # the job that has been running alone for longest, if for longer than
+    # half of the jobs took
+    if not self.speculate or self.num_pending_jobs > 0 or len(self.durations) == 0:
+      return None
+
+    median_duration = sorted(self.durations)[len(self.durations) // 2]
+    now = time.time()
+    backup_job = None
+    backup_start = None
+    for job, copies in self.running.items():
+      if job in self.finished or len(copies) != 1 or copies[0][0] is server or server in self.failed_on[job]:
+        continue
+
+      start = copies[0][1]
+      if now - start > median_duration and (backup_start is None or start < backup_start):
+        backup_job, backup_start = job, start
+
+    return backup_job
+
+  def _unqueue(self, job):
+    self.pending_jobs[job.directory].remove(job)
+    if len(self.pending_jobs[job.directory]) == 0:
+      del self.pending_jobs[job.directory]
+    self.num_pending_jobs -= 1
+
+  def _start(self, job, server):
+    self.running[job].append([server, time.time()])
+    self.results[job] = {'status': 'running', 'server': str(server)}
+
+  def _stop(self, job, server):
+    """Forget the copy of job running on server; returns how long it ran, or
+    None if it was given up on already."""
+    for copy in self.running.get(job, ()):
+      if copy[0] is server:
+        self.running[job].remove(copy)
+        if len(self.running[job]) == 0:
+          del self.running[job]
+        return time.time() - copy[1]
+
+    return None
+
+  def _finish(self, job, result):
+    if job in self.pending_jobs.get(job.directory, ()):
+      self._unqueue(job)
+
+    # copies still running lost the race, which is no failure of their server
+    self.running.pop(job, None)
+
+    self.results[job] = result
+    self._write_journal(job, result)
+    self.finished.add(job)
+    self.num_unfinished_jobs -= 1
+    self.condition.notify_all()
+
+  def job_cached(self, job, result, server):
+    """Finish job, which server took, with a result from its cache."""
+    with self.condition:
+      self._stop(job, server)
+      if job not in self.finished:
+        self._finish(job, result)
+
+  def job_done(self, job, result, server=None):
+    with self.condition:
+      duration = self._stop(job, server)
+      self.consecutive_failures[server] = 0
+
+      # a copy that timed out may still finish first
+      if job in self.finished:
+        self.logger.debug(str(server) + " finished " + str(job) + " after another copy did.")
+        return
+
+      if duration is not None:
+        self.durations.append(duration)
+      self._finish(job, result)
+
+  def _write_journal(self, job, result):
+    # called with the lock held, so lines don't interleave
+    if self.journal is None:
+      return
+
+    entry = dict(job._asdict())
+    entry['result'] = result
+    self.journal.write(json.dumps(entry) + '\n')
+    self.journal.flush()
+    os.fsync(self.journal.fileno())
+
+  def jobs_failed(self, jobs, server, exception):
+    """Queue jobs, which failed together on server, again; counts as one
+    failure of server."""
+    self.logger.error(str(server) + " failed to run " + ', '.join(str(job) for job in jobs) + ":\n" + traceback.format_exc())
+    with self.condition:
+      # copies given up on already (timed out) were counted as failed then
+      jobs = [job for job in jobs if self._stop(job, server) is not None]
+      if len(jobs) > 0:
+        self._attempts_failed(jobs, server, repr(exception))
+
+  def _attempts_failed(self, jobs, server, error):
+    self.consecutive_failures[server] += 1
+    if self.consecutive_failures[server] >= self.quarantine_after and server not in self.quarantined:
+      self.logger.error("Quarantining " + str(server) + " after " + str(self.consecutive_failures[server]) + " failures in a row.")
+      self.quarantined.add(server)
+
+    for job in jobs:
+      self.failures[job] += 1
+      self.failed_on[job].add(server)
+
+      # still running elsewhere, or already done by another copy
+      if job in self.finished or job in self.running:
+        continue
+
+      if self.failures[job] < self.max_attempts:
+        self.logger.warning("Queueing " + str(job) + " again after " + str(self.failures[job]) + " failed attempt(s).")
+        self.pending_jobs.setdefault(job.directory, deque()).append(job)
+        self.num_pending_jobs += 1
+        self.results[job] = {'status': 'waiting'}
+      else:
+        self._finish(job, {'status': 'failed', 'server': str(server), 'error': error})
+
+    self.condition.notify_all()
+
+  def _watch_timeouts(self):
+    # the runner's thread stays stuck, but its job is queued again
+    while True:
+      time.sleep(1)
+      with self.condition:
+        now = time.time()
+        for job, copies in list(self.running.items()):
+          for server, start in list(copies):
+            if now - start > self.job_timeout:
+              self.logger.error(str(server) + " did not finish " + str(job) + " within " + str(self.job_timeout) + " seconds.")
+              self._stop(job, server)
+              self._attempts_failed([job], server, 'timed out after ' + str(self.job_timeout) + ' seconds')
+
+  def _count_running(self, server):
+    num_jobs = sum(1 for copies in self.running.values() for copy in copies if copy[0] is server)
+    return (num_jobs + server.batch_size - 1) // server.batch_size
+
+  def _watch_capacity(self):
+    while True:
+      time.sleep(self.probe_interval)
+      with self.condition:
+        servers = [(server, self._count_running(server)) for server in self.servers if server not in self.quarantined]
+
+      # probing takes a round trip to each server, so not under the lock
+      for server, num_running in servers:
+        try:
+          server.probe_capacity(num_running)
+        except Exception as e:
+          self.logger.warning("Probing " + str(server) + " failed: " + repr(e))
+
+      with self.condition:
+        for server, _ in servers:
+          self._start_slots(server)
+        self.condition.notify_all()
+
+  def wait(self):
+    with self.condition:
+      while self.num_unfinished_jobs > 0:
+        if len(self.servers) > 0 and all(server in self.quarantined for server in self.servers):
+          self.logger.critical("Every server is quarantined, giving up on the remaining jobs.")
+          for job in list(self.results.keys()):
+            if job not in self.finished:
+              self._finish(job, {'status': 'failed', 'error': 'every server is quarantined'})
+          break
+
+        # waiting with a timeout keeps Ctrl-C working under python 2
+        self.condition.wait(1)
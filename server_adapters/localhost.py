@@ -1,15 +1,128 @@
 from __future__ import print_function
-from .runner import Runner
+from .runner import Runner, timed
+from .ssh import get_folder_hash
+from standalone_scripts.train_and_test import get_report_key, get_svm_light_hash, get_available_memory, parse_size
+from multiprocessing import cpu_count
 import sys
 import os
+import shutil
+import subprocess
+import logging
+import json
+import uuid
+
 
 class LocalRunner(Runner):
 
-  def __init__(self, working_directory):
-    raise NotImplementedError()
+  logger = None
+  needs_transfer = False
+
+  def __init__(self, working_directory, logger=None, cores=None, slots=None, batch_size=1, threshold=None, auto_weight=False, memory_budget=None, model_cache_directory='~/.py_experiment_manager/models', model_cache_quota='10G', models_per_job=None, min_free_disk='1G'):
+    self.working_directory = os.path.expanduser(working_directory)
+    self.batch_size = int(batch_size)
+    self.threshold = threshold
+    self.auto_weight = auto_weight
+    self.models_per_job = None if models_per_job is None else int(models_per_job)
+    self.min_free_disk = parse_size(min_free_disk)
+
+    # workers always split the cores between the jobs running at once
+    self.auto_slots = slots is None
+    self.auto_workers = True
+    self.auto_memory_budget = memory_budget is None
+    self.configured_slots = None if slots is None else int(slots)
+    self.slots = self.configured_slots
+    self.memory_budget = memory_budget
+    self.model_cache_directory = os.path.expanduser(model_cache_directory)
+    self.model_cache_quota = parse_size(model_cache_quota)
+    self.svm_light_hash = None
+
+    # leave a core to the master process unless told otherwise
+    if cores is None:
+      cores = max(1, cpu_count() - 1)
+    self.cores = int(cores)
+
+    if logger is None:
+      self.logger = logging.getLogger()
+    else:
+      self.logger = logger
+
+    self.script_location = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../standalone_scripts/train_and_test.py')
+
+  def __str__(self):
+    return 'localhost'
+
+  def bootstrap(self):
+    if not os.path.isdir(self.working_directory):
+      os.makedirs(self.working_directory)
+
+    self.svm_light_hash = get_svm_light_hash()
+    self.probe_capacity()
+
+  def _probe(self):
+    memory = get_available_memory()
+    disk = os.statvfs(self.working_directory)
+    return {
+      'cores': self.cores,
+      'load': os.getloadavg()[0],
+      'memory': None if memory == float('inf') else memory,
+      'disk': disk.f_bavail * disk.f_frsize,
+    }
+
+  def holds(self, folder_name):
+    return True
+
+  def get_cached_results(self, jobs):
+    results = dict()
+    for job in jobs:
+      report_entry = os.path.join(self.model_cache_directory, get_report_key(get_folder_hash(job.directory), job.svm_params, self.svm_light_hash, self.auto_weight, self.threshold))
+      try:
+        with open(os.path.join(report_entry, 'report.json')) as report_file:
+          results[job] = json.load(report_file)
+        os.utime(report_entry, None)
+      except (IOError, OSError):
+        continue
+
+    return results
+
+  def do_experiment(self, folder_name, svm_params=None):
+    if svm_params is None:
+      svm_params = ""
+
+    return self.do_experiments(folder_name, [svm_params])[0]
+
+  def do_experiments(self, folder_name, svm_params_list):
+    self.logger.info("localhost is assigned " + folder_name + ' with ' + str(len(svm_params_list)) + ' svm_params.')
+
+    # work in a folder of symlinks so that models and predictions stay out of
+    # the experiment folder
+    timings = []
+    job_folder = os.path.join(self.working_directory, os.path.basename(folder_name.rstrip('/')) + '_' + str(uuid.uuid4()))
+    with timed(timings, 'job_folder', folder_name):
+      os.makedirs(job_folder)
+      for filename in os.listdir(folder_name):
+        os.symlink(os.path.abspath(os.path.join(folder_name, filename)), os.path.join(job_folder, filename))
+
+    self.logger.info("localhost is training on " + folder_name + '...')
+    try:
+      with timed(timings, 'train_and_test', folder_name):
+        train_and_test_process = subprocess.Popen([sys.executable, self.script_location] + self.get_train_and_test_options() + ['--data-hash', get_folder_hash(folder_name), '--batch', '--'] + list(svm_params_list),
+                                                  cwd=job_folder, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        json_result, stderr = train_and_test_process.communicate()
+    finally:
+      with timed(timings, 'cleanup', folder_name):
+        self._cleanup(job_folder)
+
+    if train_and_test_process.returncode != 0 or len(json_result) == 0:
+      error_message = "Unexpected output from train_and_test.py.  STDERR:\n" + stderr
+      self.logger.critical(error_message)
+      raise RuntimeError(error_message)
+
+    try:
+      results = json.loads(json_result)
+    except ValueError:
+      raise RuntimeError("Unable to parse STDOUT with JSON parser:\n" + json_result)
 
-  def do_experiment(self, folder_name):
-    raise NotImplementedError()
+    return self.add_timings([results[svm_params] for svm_params in svm_params_list], timings)
 
-  def _cleanup():
-    raise NotImplementedError()
+  def _cleanup(self, job_folder):
+    shutil.rmtree(job_folder, ignore_errors=True)
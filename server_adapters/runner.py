@@ -1,8 +1,82 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
+from contextlib import contextmanager
+import threading
+import time
+
+
+@contextmanager
+def timed(timings, name, detail=None):
+  """Append how long the block took to timings, the way train_and_test.py
+  reports its own phases."""
+  start = time.time()
+  try:
+    yield
+  finally:
+    timings.append({'name': name, 'detail': detail, 'start': start, 'duration': time.time() - start, 'thread': threading.current_thread().name})
+
 
 class Runner():
   __metaclass__ = ABCMeta
 
+  # number of jobs to run on this server at once
+  slots = 1
+
+  # number of jobs on the same folder to hand to one do_experiments call
+  batch_size = 1
+
+  # False for servers that read folders in place, for which placing jobs
+  # where their folder already is makes no difference
+  needs_transfer = True
+
+  # passed on to train_and_test.py --threshold unless None
+  threshold = None
+
+  # passed on to train_and_test.py --auto-weight
+  auto_weight = False
+
+  # passed on to train_and_test.py --workers and --memory-budget unless None,
+  # leaving it to use every core and the memory available
+  workers = None
+  memory_budget = None
+
+  # with these set, slots, workers and memory_budget (whichever weren't given)
+  # follow the capacity the host has left, as probe_capacity last found it:
+  # enough workers for the models_per_job models of each batch_size jobs,
+  # and as many slots as the free cores fit
+  auto_slots = False
+  auto_workers = False
+  auto_memory_budget = False
+  models_per_job = None
+  capacity = None
+
+  # slots as given, which slots only departs from while disk is short; and the
+  # most slots automatic sizing may give, e.g. as many as jobs can run at once
+  configured_slots = None
+  max_slots = None
+
+  # below this much free space in the working directory, take one job at a time
+  min_free_disk = 1 << 30
+
+  # models, predictions and reports are kept here, keyed by what they depend
+  # on, so that no job or model is run twice with the same data, svm_params
+  # and SVMLight; None to turn it off
+  model_cache_directory = None
+  model_cache_quota = None
+
+  def get_train_and_test_options(self):
+    options = []
+    if self.workers is not None:
+      options.extend(['--workers', str(self.workers)])
+    if self.memory_budget is not None:
+      options.extend(['--memory-budget', str(self.memory_budget)])
+    if self.model_cache_directory is not None:
+      options.extend(['--model-cache', self.model_cache_directory, '--model-cache-quota', str(self.model_cache_quota)])
+    if self.threshold is not None:
+      options.extend(['--threshold', str(self.threshold)])
+    if self.auto_weight:
+      options.append('--auto-weight')
+    return options
+
   @abstractproperty
   def logger(self): pass
 
@@ -12,10 +86,108 @@ class Runner():
   @abstractmethod
   def _cleanup(self): pass
 
-  def grab_jobs(self, queue, results):
+  def _probe(self):
+    """The host's cores, load average and available memory and disk, as a
+    dict, or None if unknown."""
+    return None
+
+  def probe_capacity(self, num_running=0):
+    """Size slots, workers and memory_budget after the host's capacity, with
+    num_running of our own train_and_test.py runs on it."""
+    capacity = self._probe()
+    if capacity is None:
+      if self.slots is None:
+        self.slots = 1
+      return
+
+    previous_sizes = (self.slots, self.workers)
+
+    # our own runs add to the load and hold memory too
+    external_load = max(0, capacity['load'] - num_running * (self.workers or 1))
+    available_cores = max(1, capacity['cores'] - int(round(external_load)))
+
+    if self.auto_workers:
+      models_per_run = (self.models_per_job or available_cores) * self.batch_size
+      if self.auto_slots:
+        self.workers = max(1, min(available_cores, models_per_run))
+      else:
+        self.workers = max(1, available_cores // self.configured_slots)
+
+    slots = self.configured_slots
+    if self.auto_slots:
+      slots = max(1, available_cores // (self.workers or available_cores))
+      if self.max_slots is not None:
+        slots = min(slots, self.max_slots)
+    if capacity['disk'] is not None and capacity['disk'] < self.min_free_disk:
+      self.logger.warning(str(self) + " has only " + str(capacity['disk'] >> 20) + "M of disk left, taking one job at a time.")
+      slots = 1
+
+    if self.auto_memory_budget and capacity['memory'] is not None:
+      held_memory = num_running * (self.memory_budget or 0)
+      self.memory_budget = (capacity['memory'] + held_memory) // slots
+
+    if self.capacity is None or (slots, self.workers) != previous_sizes:
+      self.logger.info(str(self) + " has " + str(capacity['cores']) + " cores at load " + str(capacity['load']) + ": runs " + str(slots) + " job(s) at once with " + str(self.workers) + " worker(s) each.")
+    self.capacity = capacity
+    self.slots = slots
+
+  def bootstrap(self):
+    """Prepare the server for experiments; called once, possibly in a thread
+    alongside other servers' bootstraps."""
+    pass
+
+  def holds(self, folder_name):
+    """Whether the server already has folder_name, so that a job on it needs no transfer."""
+    return False
+
+  def get_cached_results(self, jobs):
+    """Results of those jobs that the server's model cache already has a
+    report for, as job -> result."""
+    return {}
+
+  def do_experiments(self, folder_name, svm_params_list):
+    """Run one experiment per svm_params on folder_name and return their
+    results in the same order.  Runners that can train several svm_params in
+    one go should override this."""
+    return [self.do_experiment(folder_name, svm_params) for svm_params in svm_params_list]
+
+  def add_timings(self, results, timings):
+    """Put the runner's own timings of a do_experiments call before the ones
+    train_and_test.py returned with each result, all marked with this server."""
+    for result in results:
+      result['timings'] = [dict(timing) for timing in timings] + result.get('timings', [])
+      for timing in result['timings']:
+        timing['host'] = str(self)
+    return results
+
+  def grab_jobs(self, scheduler, slot_id=None):
+    # one of these runs per slot
     while True:
-      job = queue.get()
-      result = self.do_experiment(job.directory, job.svm_params)
-      self.logger.debug(str(job) + ': ' + str(result))
-      results[job] = result
-      queue.task_done()
+      jobs = scheduler.next_jobs(self, self.batch_size, slot_id)
+      if len(jobs) == 0:  # quarantined, or the slot was taken away
+        return
+
+      # jobs run earlier, maybe for another experiment, need no transfer
+      try:
+        cached_results = self.get_cached_results(jobs)
+      except Exception as e:
+        self.logger.warning("Could not look up " + str(self) + "'s cached results: " + repr(e))
+        cached_results = {}
+
+      if len(cached_results) > 0:
+        self.logger.info(str(self) + " had the results of " + str(len(cached_results)) + " job(s) cached.")
+        for job, result in cached_results.items():
+          scheduler.job_cached(job, result, self)
+        jobs = [job for job in jobs if job not in cached_results]
+        if len(jobs) == 0:
+          continue
+
+      try:
+        results = self.do_experiments(jobs[0].directory, [job.svm_params for job in jobs])
+      except Exception as e:
+        scheduler.jobs_failed(jobs, self, e)
+        continue
+
+      for job, result in zip(jobs, results):
+        self.logger.debug(str(job) + ': ' + str(result))
+        scheduler.job_done(job, result, self)
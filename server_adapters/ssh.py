@@ -1,78 +1,220 @@
 from __future__ import print_function
-from .runner import Runner
+from .runner import Runner, timed
+from standalone_scripts.train_and_test import get_report_key
 from paramiko import SSHClient, SFTPClient, AutoAddPolicy
 from pipes import quote
 import sys
 import os
-import tarfile
 import subprocess
 import hashlib
 import logging
 import json
 import uuid
+import threading
+import socket
+from collections import Counter
+
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+
+# codec -> (local compressor command, remote decompressor command)
+TRANSFER_CODECS = {
+  'none': (None, None),
+  'gzip': (['gzip', '-c'], 'gzip -dc'),
+  'lz4': (['lz4', '-c'], 'lz4 -dc'),
+  'zstd': (['zstd', '-c', '-q'], 'zstd -dc'),
+}
+TRANSFER_CHUNK_SIZE = 1 << 18
+
+# runners look up folders in their own threads; each folder is hashed by one
+# of them while the others wait for its .md5 file
+hashing_locks = dict()
+hashing_locks_lock = threading.Lock()
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+  """'500M', '20G' or a plain number of bytes."""
+  size = str(size).strip().upper()
+  if size[-1:] in SIZE_SUFFIXES:
+    return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+  return int(size)
+
+
+def get_folder_signature(folder_name):
+  signature = []
+  for directory, _, filenames in os.walk(folder_name):
+    for filename in filenames:
+      stat = os.stat(os.path.join(directory, filename))
+      signature.append([os.path.relpath(os.path.join(directory, filename), folder_name), stat.st_size, stat.st_mtime])
+
+  return sorted(signature)
+
+
+def get_folder_hash(folder_name):
+  """md5 of the names and contents of every file in folder_name.
+
+  The result is remembered in a <folder_name>.md5 file next to the folder,
+  together with the sizes and mtimes it was computed from, so each folder is
+  only read once no matter how many runners ask for it."""
+  with hashing_locks_lock:
+    hashing_lock = hashing_locks.setdefault(folder_name, threading.Lock())
+
+  with hashing_lock:
+    return _get_folder_hash_locked(folder_name)
+
+
+def _get_folder_hash_locked(folder_name):
+  signature = get_folder_signature(folder_name)
+  hash_filename = folder_name.rstrip('/') + '.md5'
+
+  try:
+    with open(hash_filename) as hash_file:
+      saved = json.load(hash_file)
+    if saved['signature'] == signature:
+      return saved['hash']
+  except (IOError, OSError, ValueError, KeyError):
+    pass
+
+  folder_hash = hashlib.md5()
+  for relative_filename, _, _ in signature:
+    folder_hash.update(relative_filename.encode('utf-8') + b'\0')
+    with open(os.path.join(folder_name, relative_filename), 'rb') as input_file:
+      for chunk in iter(lambda: input_file.read(1 << 20), b''):
+        folder_hash.update(chunk)
+  folder_hash = folder_hash.hexdigest()
+
+  # several runner processes may get here at once, so write then rename
+  temp_filename = hash_filename + '.' + str(uuid.uuid4())
+  with open(temp_filename, 'w') as hash_file:
+    json.dump({'signature': signature, 'hash': folder_hash}, hash_file)
+  os.rename(temp_filename, hash_filename)
+
+  return folder_hash
 
 
 class SSHRunner(Runner):
 
-  environment_variables = set()
-  ssh = None
-  ssh_closed = True
   bin_path = ""
 
-  def __init__(self, username, hostname, working_directory, logger=None):
+  def __init__(self, username, hostname, working_directory, logger=None, cache_directory='~/.py_experiment_manager/cache', cache_quota='10G', max_channels=8, transfer_codec='gzip', connect_timeout=30, slots=None, batch_size=1, threshold=None, auto_weight=False, workers=None, memory_budget=None, model_cache_directory='~/.py_experiment_manager/models', model_cache_quota='10G', models_per_job=None, min_free_disk='1G'):
     self.username = username
     self.hostname = hostname
+    self.batch_size = int(batch_size)
+    self.threshold = threshold
+    self.auto_weight = auto_weight
+    self.models_per_job = None if models_per_job is None else int(models_per_job)
+    self.min_free_disk = parse_size(min_free_disk)
+
+    # whatever isn't given is sized after the server's capacity once connected
+    self.auto_slots = slots is None
+    self.auto_workers = workers is None
+    self.auto_memory_budget = memory_budget is None
+    self.configured_slots = None if slots is None else int(slots)
+    self.slots = self.configured_slots
+    self.workers = None if workers is None else int(workers)
+    self.memory_budget = memory_budget
+    self.cache_quota = parse_size(cache_quota)
+    self.model_cache_quota = parse_size(model_cache_quota)
+    self.svm_light_hash = None
+    self.cached_keys = set()
+
+    # one long-lived connection per server; commands share it as separate
+    # channels, at most max_channels at a time (sshd's MaxSessions is 10 by default)
+    self.ssh = None
+    self.sftp = None
+    self.connection_pid = None
+    self.connection_lock = threading.Lock()
+    self.channel_slots = threading.BoundedSemaphore(int(max_channels))
+    self.caching_locks = dict()
+    self.hashes_in_use = Counter()  # dataset cache entries jobs are running from
+    self.cached_hashes = set()
+    self.environment_variables = set()
+    self.command_prefix = ''
+    self.connect_timeout = float(connect_timeout)
+
+    # a job holds a channel while it trains; leave one for probes and transfers
+    self.max_slots = max(1, int(max_channels) - 1)
+
+    # paths may start with ~, which is only known once connected
+    self.working_directory = working_directory
+    self.cache_directory = cache_directory
+    self.model_cache_directory = model_cache_directory
+
+    # folders are streamed through tar | compressor | ssh | decompressor | tar,
+    # so the compressor has to exist on both ends
+    if transfer_codec not in TRANSFER_CODECS:
+      raise ValueError("Unknown transfer_codec " + transfer_codec + ", expected one of " + ', '.join(sorted(TRANSFER_CODECS)))
+    self.transfer_codec = transfer_codec
 
     if logger is None:
       self.logger = logging.getLogger()
     else:
       self.logger = logger
 
-    self.logger.info("Connecting to " + username + "@" + hostname + "...")
+  def __str__(self):
+    return self.username + '@' + self.hostname
+
+  def bootstrap(self):
+    hostname = self.hostname
+
+    self.logger.info("Connecting to " + self.username + "@" + hostname + "...")
 
     # try connecting to it
     self._ensure_connected()
 
-    _, home, _ = self.ssh.exec_command("pwd")
-    home = home.read().strip()
+    _, home, _ = self._execute("pwd")
+    home = home.strip()
     self.bin_path = os.path.join(home, 'bin')
-    self.working_directory = working_directory.replace('~', home)
+    self.working_directory = self.working_directory.replace('~', home)
+    self.cache_directory = self.cache_directory.replace('~', home)
+    self.model_cache_directory = self.model_cache_directory.replace('~', home)
 
     # add ~/bin to path if it is not already there
-    _, path, _ = self.ssh.exec_command("echo $PATH")
-    path_string = path.read()
-    if home + '/bin' not in path_string.split(':'):
+    _, path_string, _ = self._execute("echo $PATH")
+    if home + '/bin' not in path_string.strip().split(':'):
       self.environment_variables.add(('PATH', self.bin_path + ':$PATH'))
+    self.command_prefix = ''.join(['export ' + e[0] + '=' + e[1] + '; ' for e in self.environment_variables])
+
+    compress_command, decompress_command = TRANSFER_CODECS[self.transfer_codec]
+    if compress_command is not None:
+      if which(compress_command[0]) is None or self._run_command_and_wait("which " + decompress_command.split()[0]) != 0:
+        self.logger.warning(compress_command[0] + " is not available here or on " + hostname + ", transferring folders uncompressed.")
+        self.transfer_codec = 'none'
 
     # check if SVMLight is installed
-    _, svmlearn_location, _ = self._run_command("which svm_learn")
-    svmlearn_location = svmlearn_location.read().strip()
+    _, svmlearn_location, _ = self._execute("which svm_learn")
+    svmlearn_location = svmlearn_location.strip()
 
     if len(svmlearn_location) > 0:
       self.logger.info(hostname + " has SVMLight installed at " + svmlearn_location)
     else:
       self.logger.warning(hostname + " does not have SVMLight installed.  Attempting to install one...")
       
-      self._run_command("mkdir -p " + self.bin_path)
+      self._execute("mkdir -p " + self.bin_path)
 
       # download and install SVMLight to home bin
-      self._run_command('wget -O ' + quote(os.path.join(self.bin_path, 'svm_learn')) + ' ' + 'https://static.jiehan.org/pub/svm_light/svm_learn')
-      self._run_command('wget -O ' + quote(os.path.join(self.bin_path, 'svm_classify')) + ' ' + 'https://static.jiehan.org/pub/svm_light/svm_classify')
-      self._run_command("chmod u+x " + quote(os.path.join(self.bin_path, 'svm_learn')))
-      self._run_command("chmod u+x " + quote(os.path.join(self.bin_path, 'svm_classify')))
+      self._execute('wget -O ' + quote(os.path.join(self.bin_path, 'svm_learn')) + ' ' + 'https://static.jiehan.org/pub/svm_light/svm_learn')
+      self._execute('wget -O ' + quote(os.path.join(self.bin_path, 'svm_classify')) + ' ' + 'https://static.jiehan.org/pub/svm_light/svm_classify')
+      self._execute("chmod u+x " + quote(os.path.join(self.bin_path, 'svm_learn')))
+      self._execute("chmod u+x " + quote(os.path.join(self.bin_path, 'svm_classify')))
 
     # check if our server-side script is installed
     install_helper_script = True
 
     local_script_location = os.path.join(os.path.dirname(__file__), '../standalone_scripts/train_and_test.py')
 
-    _, script_location, _ = self._run_command("which train_and_test.py")
-    script_location = script_location.read().strip()
+    _, script_location, _ = self._execute("which train_and_test.py")
+    script_location = script_location.strip()
 
     if len(script_location) > 0:
       # check version
-      _, script_md5_line, _ = self._run_command("md5sum " + quote(script_location))
-      remote_script_md5, _ = script_md5_line.read().strip().split()[:2]
+      _, script_md5_line, _ = self._execute("md5sum " + quote(script_location))
+      remote_script_md5, _ = script_md5_line.strip().split()[:2]
       local_script_md5 = hashlib.md5(open(local_script_location, 'rb').read()).hexdigest()
 
       if remote_script_md5 == local_script_md5:
@@ -87,99 +229,270 @@ class SSHRunner(Runner):
     if install_helper_script:
       self.logger.info("Copying helper script to " + hostname + '...')
       self._copy_to_server(local_script_location, self.bin_path)
-      self._run_command("chmod u+x " + quote(os.path.join(self.bin_path, 'train_and_test.py')))
+      self._execute("chmod u+x " + quote(os.path.join(self.bin_path, 'train_and_test.py')))
+
+    # create working directory, but keep the dataset cache from earlier runs
+    _, stdout, stderr = self._execute("rm -rf " + quote(self.working_directory) + " && mkdir -p " + quote(self.working_directory) + ' ' + quote(self.cache_directory) + ' ' + quote(self.model_cache_directory))
+    self.logger.debug("create working directory STDOUT: " + stdout)
+    self.logger.debug("create working directory STDERR: " + stderr)
+
+    _, cache_listing, _ = self._execute("ls " + quote(self.cache_directory))
+    self.cached_hashes = set(cache_listing.split())
+
+    # the model cache is keyed by SVMLight's build too
+    _, svm_light_md5_line, _ = self._execute('cat "$(which svm_learn)" "$(which svm_classify)" | md5sum')
+    self.svm_light_hash = svm_light_md5_line.split()[0]
 
-    # create working directory
-    _, stdout, stderr = self._run_command("rm -rf " + quote(self.working_directory) + " && mkdir -p " + quote(self.working_directory))
-    self.logger.debug("create working directory STDOUT: " + stdout.read())
-    self.logger.debug("create working directory STDERR: " + stderr.read())
+    _, model_cache_listing, _ = self._execute("ls " + quote(self.model_cache_directory))
+    self.cached_keys = set(model_cache_listing.split())
 
-    self.ssh.close()
-    self.ssh_closed = True
+    self.probe_capacity()
 
 
   def logger(self):
     return logger
 
   def _ensure_connected(self):
-    if self.ssh_closed:
+    with self.connection_lock:
+      # a connection only works in the process that opened it, since forked
+      # children don't get paramiko's transport thread; don't close it there
+      if self.ssh is not None and self.connection_pid == os.getpid():
+        transport = self.ssh.get_transport()
+        if transport is not None and transport.is_active():
+          return
+
+        # the keepalive failed or the server went away
+        self.logger.warning("Lost connection to " + self.hostname + ", reconnecting...")
+        self.ssh.close()
+
       self.ssh = SSHClient()
       self.ssh.load_system_host_keys()
       self.ssh.set_missing_host_key_policy(AutoAddPolicy())
-      self.ssh.connect(self.hostname, username=self.username)
+      self.ssh.connect(self.hostname, username=self.username, timeout=self.connect_timeout, banner_timeout=self.connect_timeout)
       self.ssh.get_transport().set_keepalive(30)
-      self.ssh_closed = False
+      self.sftp = None
+      self.connection_pid = os.getpid()
 
+  def _get_sftp(self):
+    self._ensure_connected()
+    with self.connection_lock:
+      if self.sftp is None:
+        self.sftp = SFTPClient.from_transport(self.ssh.get_transport())
+      return self.sftp
 
   def _run_command(self, command):
     self._ensure_connected()
-    if self.environment_variables is not None:
-      command = '; '.join(['export ' + e[0] + '=' + e[1] for e in self.environment_variables]) + '; ' + command
+    command = self.command_prefix + command
 
     self.logger.debug("SSH: " + command)
     return self.ssh.exec_command(command)
 
+  def _execute(self, command):
+    """Run command and wait for it to finish.  Returns its exit status, STDOUT and STDERR."""
+    with self.channel_slots:
+      _, stdout, stderr = self._run_command(command)
+      stdout_string = stdout.read()
+      stderr_string = stderr.read()
+      return stdout.channel.recv_exit_status(), stdout_string, stderr_string
+
+  def _run_command_and_wait(self, command):
+    return self._execute(command)[0]
+
+  def _probe(self):
+    probe_command = 'nproc; cat /proc/loadavg; grep MemAvailable /proc/meminfo; df -Pk ' + quote(self.working_directory) + ' | tail -1'
+    exit_status, stdout, stderr = self._execute('/bin/sh -c ' + quote(probe_command))
+    try:
+      lines = stdout.splitlines()
+      return {
+        'cores': int(lines[0]),
+        'load': float(lines[1].split()[0]),
+        'memory': int(lines[2].split()[1]) * 1024,
+        'disk': int(lines[3].split()[3]) * 1024,
+      }
+    except (IndexError, ValueError):
+      self.logger.warning("Could not probe " + self.hostname + "'s capacity: " + stderr.strip())
+      return None
+
+  def holds(self, folder_name):
+    # nothing to hash folders for on a first run
+    if len(self.cached_hashes) == 0:
+      return False
+    return get_folder_hash(folder_name) in self.cached_hashes
+
+  def get_cached_results(self, jobs):
+    results = dict()
+    if len(self.cached_keys) == 0:
+      return results
+
+    for job in jobs:
+      report_key = get_report_key(get_folder_hash(job.directory), job.svm_params, self.svm_light_hash, self.auto_weight, self.threshold)
+      if report_key not in self.cached_keys:
+        continue
+
+      report_entry = os.path.join(self.model_cache_directory, report_key)
+      status, json_result, _ = self._execute('touch ' + quote(report_entry) + ' && cat ' + quote(os.path.join(report_entry, 'report.json')))
+      if status == 0:
+        results[job] = json.loads(json_result)
+
+    return results
+
   def do_experiment(self, folder_name, svm_params=None):
     if svm_params is None:
       svm_params = ""
 
+    return self.do_experiments(folder_name, [svm_params])[0]
+
+  def do_experiments(self, folder_name, svm_params_list):
     self._ensure_connected()
-    self.logger.info(self.hostname + " is assigned " + folder_name + '.')
+    self.logger.info(self.hostname + " is assigned " + folder_name + ' with ' + str(len(svm_params_list)) + ' svm_params.')
 
-    # copy folder over
-    self._copy_to_server(folder_name)
+    # the cache entry must outlive the job, whatever other slots evict meanwhile
+    folder_hash = get_folder_hash(folder_name)
+    with self.connection_lock:
+      self.hashes_in_use[folder_hash] += 1
+
+    try:
+      return self._do_experiments_in_cache(folder_name, folder_hash, svm_params_list)
+    finally:
+      with self.connection_lock:
+        self.hashes_in_use[folder_hash] -= 1
+        if self.hashes_in_use[folder_hash] == 0:
+          del self.hashes_in_use[folder_hash]
+
+  def _do_experiments_in_cache(self, folder_name, folder_hash, svm_params_list):
+    # make sure the folder is in the dataset cache, then work in a folder of
+    # symlinks to it so that models and predictions don't end up in the cache
+    timings = []
+    with timed(timings, 'dataset_cache', folder_name):
+      cached_folder = self._ensure_cached(folder_name, folder_hash, timings)
+    job_folder = folder_name + '_' + str(uuid.uuid4())
+    with timed(timings, 'job_folder', folder_name):
+      self._run_command_and_wait('mkdir ' + quote(os.path.join(self.working_directory, job_folder)) + ' && ln -s ' + quote(cached_folder) + '/* ' + quote(os.path.join(self.working_directory, job_folder)))
 
     # the "python `which ...`" thing is a workaround to avoid using Columbia's old Python
     self.logger.info(self.hostname + " is training on " + folder_name + '...')
-    _, stdout, stderr = self._run_command('/bin/bash --login -c ' + quote('cd ' + self.working_directory + '/' + folder_name + '; ' + 'python `which train_and_test.py` ' + quote(svm_params)))
-
-    json_result = stdout.read()
+    # every svm_params is trained in the same invocation, which reads the labels once
+    with timed(timings, 'train_and_test', folder_name):
+      _, json_result, stderr = self._execute('/bin/bash --login -c ' + quote('cd ' + self.working_directory + '/' + job_folder + '; ' + 'python `which train_and_test.py` ' + ' '.join(quote(option) for option in self.get_train_and_test_options()) + ' --data-hash ' + folder_hash + ' --batch -- ' + ' '.join(quote(svm_params) for svm_params in svm_params_list)))
 
     if len(json_result) == 0:
-      error_message = "Unexpected output from remote server.  STDERR:\n" + stderr.read()
+      error_message = "Unexpected output from remote server.  STDERR:\n" + stderr
       self.logger.critical(error_message)
       raise RuntimeError(error_message)
 
-    self._cleanup(folder_name)
-
-    # XXX maybe this will help solving the getting stuck problem 
-    self.ssh.close()
-    self.ssh_closed = True
+    with timed(timings, 'cleanup', folder_name):
+      self._cleanup(job_folder)
+      self._run_command_and_wait('touch -c ' + quote(cached_folder))
 
     try:
-      return json.loads(json_result)
+      results = json.loads(json_result)
     except ValueError:
       raise RuntimeError("Unable to parse STDOUT with JSON parser:\n" + json_result)
 
-  def _copy_to_server(self, filename, destination=None):
-    self._ensure_connected()
+    return self.add_timings([results[svm_params] for svm_params in svm_params_list], timings)
+
+  def _ensure_cached(self, folder_name, folder_hash, timings):
+    # jobs running side by side on this server upload each folder only once
+    with self.connection_lock:
+      caching_lock = self.caching_locks.setdefault(folder_hash, threading.Lock())
+
+    with caching_lock:
+      return self._ensure_cached_locked(folder_name, folder_hash, timings)
+
+  def _ensure_cached_locked(self, folder_name, folder_hash, timings):
+    cached_folder = os.path.join(self.cache_directory, folder_hash)
+
+    # touching marks the entry as recently used for eviction
+    if self._run_command_and_wait('test -d ' + quote(cached_folder) + ' && touch ' + quote(cached_folder)) == 0:
+      self.logger.info(self.hostname + " has " + folder_name + " cached as " + folder_hash + '.')
+      self.cached_hashes.add(folder_hash)
+      return cached_folder
+
+    # upload next to the cache (hidden from eviction) and move it in when complete
+    partial_folder = os.path.join(self.cache_directory, '.' + folder_hash + '_' + str(uuid.uuid4()))
+    self._run_command_and_wait('mkdir -p ' + quote(partial_folder))
+    # compression, upload and extraction overlap, so they are timed as one
+    with timed(timings, 'transfer', folder_name):
+      self._copy_to_server(folder_name, partial_folder)
+    self._run_command_and_wait('/bin/sh -c ' + quote(
+      '[ -d ' + quote(cached_folder) + ' ] || mv ' + quote(os.path.join(partial_folder, os.path.basename(folder_name.rstrip('/')))) + ' ' + quote(cached_folder) + '; '
+      'rm -rf ' + quote(partial_folder)))
+
+    self.cached_hashes.add(folder_hash)
+    with timed(timings, 'evict', folder_name):
+      with self.connection_lock:
+        in_use = list(self.hashes_in_use)
+      self._evict_from_cache(keep=in_use)
+
+    return cached_folder
+
+  def _evict_from_cache(self, keep):
+    # drop least recently used entries, except those in keep, until the cache
+    # fits in its quota
+    script = ('cd ' + quote(self.cache_directory) + ' || exit 1; '
+              'total=$(du -sk . | cut -f1); '
+              'for entry in $(ls -tr); do '
+              '[ "$total" -le ' + str(self.cache_quota // 1024) + ' ] && break; '
+              'case "$entry" in ' + '|'.join(quote(folder_hash) for folder_hash in keep) + ') continue;; esac; '
+              'size=$(du -sk "$entry" | cut -f1); '
+              'rm -rf "$entry" && total=$((total - size)) && echo "$entry"; '
+              'done')
+    _, stdout, _ = self._execute('/bin/sh -c ' + quote(script))
+
+    for evicted in stdout.split():
+      self.cached_hashes.discard(evicted)
+      self.logger.info("Evicted " + evicted + " from " + self.hostname + "'s dataset cache.")
 
+  def _copy_to_server(self, filename, destination=None):
     if destination is None:
       destination = self.working_directory
 
-    sftp = SFTPClient.from_transport(self.ssh.get_transport())
-
-    # tar and compress a directory before copying
     if os.path.isfile(filename):
-      sftp.put(filename, os.path.join(destination, os.path.basename(filename)))
+      self._get_sftp().put(filename, os.path.join(destination, os.path.basename(filename)))
     elif os.path.isdir(filename):
-      tar_filename = filename + '_' + str(uuid.uuid4()) + '.tar.gz'
-
-      self.logger.info("Compressing " + filename + '...')
-      subprocess.call(['tar', 'cfz', tar_filename, filename])
+      self._stream_folder_to_server(filename, destination)
+    else:
+      raise NotImplementedError("Can't SFTP put anything other than a folder or file yet.")
 
-      self.logger.info("Copying " + tar_filename + " to " + self.hostname + ':' + os.path.join(destination, os.path.basename(tar_filename)) + '...')
-      sftp.put(tar_filename, os.path.join(destination, os.path.basename(tar_filename)))
-      os.remove(tar_filename)
+  def _stream_folder_to_server(self, folder_name, destination):
+    # pipe a tar stream of the folder straight into a remote tar, so that
+    # compression, transfer and extraction overlap and nothing touches local disk
+    compress_command, decompress_command = TRANSFER_CODECS[self.transfer_codec]
 
-      _, stdout, stderr = self._run_command('cd ' + quote(self.working_directory) + ' && tar xvfz ' + quote(tar_filename) + ' && rm ' + quote(tar_filename))
-      self.logger.debug("tar STDOUT: " + stdout.read())
-      self.logger.debug("tar STDERR: " + stderr.read())
+    local_processes = [subprocess.Popen(['tar', 'cf', '-', folder_name], stdout=subprocess.PIPE)]
+    if compress_command is not None:
+      local_processes.append(subprocess.Popen(compress_command, stdin=local_processes[0].stdout, stdout=subprocess.PIPE))
+      local_processes[0].stdout.close()
+      remote_command = 'cd ' + quote(destination) + ' && ' + decompress_command + ' | tar xf -'
     else:
-      raise NotImplementedError("Can't SFTP put anything other than a folder or file yet.")
+      remote_command = 'cd ' + quote(destination) + ' && tar xf -'
+    tar_stream = local_processes[-1].stdout
 
-    sftp.close()
+    self.logger.info("Streaming " + folder_name + " to " + self.hostname + ':' + destination + " (" + self.transfer_codec + ")...")
+
+    with self.channel_slots:
+      self._ensure_connected()
+      channel = self.ssh.get_transport().open_session()
+      self.logger.debug("SSH: " + self.command_prefix + remote_command)
+      channel.exec_command(self.command_prefix + remote_command)
+
+      try:
+        for chunk in iter(lambda: tar_stream.read(TRANSFER_CHUNK_SIZE), b''):
+          channel.sendall(chunk)
+        channel.shutdown_write()
+      except socket.error:
+        # the remote end gave up early; its exit status and STDERR say why
+        local_processes[0].kill()
+
+      exit_status = channel.recv_exit_status()
+      remote_stderr = channel.makefile_stderr().read()
+      channel.close()
+
+    tar_stream.close()
+    local_exit_statuses = [local_process.wait() for local_process in local_processes]
+
+    if exit_status != 0 or any(local_exit_statuses):
+      raise RuntimeError("Streaming " + folder_name + " to " + self.hostname + " failed (local exit statuses " + str(local_exit_statuses) + ", remote exit status " + str(exit_status) + ").  STDERR:\n" + remote_stderr)
 
   def _cleanup(self, folder_name=''):
-    self._ensure_connected()
-    self._run_command("rm -rf " + quote(self.working_directory) + '/' + quote(folder_name))
+    self._run_command_and_wait("rm -rf " + quote(self.working_directory) + '/' + quote(folder_name))
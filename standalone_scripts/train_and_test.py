@@ -4,32 +4,265 @@ from __future__ import print_function, division
 import atexit
 import sys
 import os
+import shutil
+import hashlib
+import uuid
 from multiprocessing import Pool, cpu_count
 import subprocess
 from collections import namedtuple, defaultdict, Counter
 import json
+import argparse
+import time
+from array import array
 
+from itertools import islice
 
-Task = namedtuple('Task', ['train_filename', 'model_filename', 'prediction_filename', 'svm_params'])
-SVMReport = namedtuple('SVMReport', ['prediction_filename', 'time_train', 'time_test'])
+try:
+  from itertools import izip as zip
+except ImportError:
+  pass
+
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+
+ClassFile = namedtuple('ClassFile', ['filename', 'train_filename', 'labels_filename', 'num_pos', 'num_neg'])
+Task = namedtuple('Task', ['train_filename', 'labels_filename', 'model_filename', 'prediction_filename', 'svm_params', 'cost', 'cache_entry'])
+# time_train and time_test are (start, duration), or None if served from the
+# cache; worker is the pid of the pool process that ran the task
+SVMReport = namedtuple('SVMReport', ['prediction_filename', 'time_train', 'time_test', 'worker'])
 DEV_NULL = open(os.devnull, 'w')
+MERGE_CHUNK_SIZE = 1 << 16
+MANIFEST_FILENAME = 'manifest.json'
+
+# predicted for examples no class scores above --threshold
+NO_CLASS = -1
+
+# svm_learn holds about its training file's size in memory, plus its kernel
+# cache (-m, 40MB by default)
+KERNEL_CACHE_SIZE = 40 << 20
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
 
 
 def train_and_test(task):
   if os.path.exists(task.prediction_filename):
-    return task.prediction_filename
+    return SVMReport(task.prediction_filename, None, None, os.getpid())
+
+  if task.cache_entry is not None:
+    try:
+      os.utime(task.cache_entry, None)
+      link_or_copy(os.path.join(task.cache_entry, 'prediction'), task.prediction_filename)
+      print("Using cached", task.model_filename, "from", task.cache_entry + "...", file=sys.stderr)
+      return SVMReport(task.prediction_filename, None, None, os.getpid())
+    except (IOError, OSError):  # not cached, or evicted meanwhile
+      pass
 
   os.nice(19)
+  train_start = time.time()
+
+  # svm_learn reads its input twice, so the +1/-1 view of a shared train file
+  # has to be a real file rather than a FIFO
+  if task.labels_filename is not None:
+    train_filename = task.model_filename.replace('model', 'view', 1)
+    write_training_view(task.train_filename, task.labels_filename, train_filename)
+  else:
+    train_filename = task.train_filename
+
   print("Training", task.model_filename, "with params", task.svm_params + "...", file=sys.stderr)
-  svm_learn_process = subprocess.Popen(['/bin/bash', '-c', ' '.join(["svm_learn", task.svm_params, task.train_filename, task.model_filename])], stdout=DEV_NULL, stderr=DEV_NULL)
+  svm_learn_process = subprocess.Popen(['/bin/bash', '-c', ' '.join(["svm_learn", task.svm_params, train_filename, task.model_filename])], stdout=DEV_NULL, stderr=DEV_NULL)
   atexit.register(_kill, svm_learn_process)
   svm_learn_process.wait()
+
+  if task.labels_filename is not None:
+    os.remove(train_filename)
+  time_train = (train_start, time.time() - train_start)
+
+  test_start = time.time()
   print("Testing using", task.model_filename + "...", file=sys.stderr)
   svm_classify_process = subprocess.Popen(['/bin/bash', '-c', ' '.join(["svm_classify", 'test', task.model_filename, task.prediction_filename])], stdout=DEV_NULL, stderr=DEV_NULL)
   atexit.register(_kill, svm_classify_process)
   svm_classify_process.wait()
+  time_test = (test_start, time.time() - test_start)
+
+  if task.cache_entry is not None and svm_learn_process.returncode == 0 and svm_classify_process.returncode == 0:
+    store_in_cache(task.cache_entry, {'model': task.model_filename, 'prediction': task.prediction_filename})
+
+  return SVMReport(task.prediction_filename, time_train, time_test, os.getpid())
+
+
+def normalize_svm_params(svm_params):
+  """Order svm_learn's options so that '-t 0 -c 1' and '-c 1 -t 0' are the
+  same; svm_learn takes the last of repeated options."""
+  tokens = svm_params.split()
+  if len(tokens) % 2 != 0 or not all(option.startswith('-') for option in tokens[0::2]):
+    return ' '.join(tokens)
+
+  options = dict(zip(tokens[0::2], tokens[1::2]))
+  return ' '.join(option + ' ' + options[option] for option in sorted(options))
+
+
+def get_svm_light_hash():
+  # same as `cat $(which svm_learn) $(which svm_classify) | md5sum` on the master's side
+  svm_light_hash = hashlib.md5()
+  for program in ['svm_learn', 'svm_classify']:
+    with open(which(program), 'rb') as program_file:
+      svm_light_hash.update(program_file.read())
+
+  return svm_light_hash.hexdigest()
+
+
+def get_cache_key(*parts):
+  return hashlib.md5(json.dumps(list(parts)).encode('utf-8')).hexdigest()
+
+
+def get_model_key(data_hash, class_suffix, svm_params, svm_light_hash):
+  return get_cache_key('model', data_hash, class_suffix, normalize_svm_params(svm_params), svm_light_hash)
+
+
+def get_report_key(data_hash, svm_params, svm_light_hash, auto_weight, threshold):
+  return get_cache_key('report', data_hash, normalize_svm_params(svm_params), svm_light_hash, bool(auto_weight), threshold)
+
+
+def link_or_copy(source, destination):
+  # a hard link keeps the file even if the cache entry is evicted meanwhile
+  try:
+    os.link(source, destination)
+  except OSError:
+    shutil.copyfile(source, destination)
+
+
+def store_in_cache(cache_entry, files):
+  """Copy files (name in the entry -> path) to cache_entry, moving them in
+  all at once so that readers never see a partial entry."""
+  partial_entry = os.path.join(os.path.dirname(cache_entry), '.' + os.path.basename(cache_entry) + '_' + str(uuid.uuid4()))
+  os.makedirs(partial_entry)
+  for name, filename in files.items():
+    link_or_copy(filename, os.path.join(partial_entry, name))
+
+  try:
+    os.rename(partial_entry, cache_entry)
+  except OSError:  # stored by another job meanwhile
+    shutil.rmtree(partial_entry, ignore_errors=True)
+
 
-  return task.prediction_filename
+def evict_from_cache(cache_directory, quota):
+  # least recently used entries first; hidden ones are still being stored
+  entries = []
+  total_size = 0
+  for entry_name in os.listdir(cache_directory):
+    if entry_name.startswith('.'):
+      continue
+
+    cache_entry = os.path.join(cache_directory, entry_name)
+    try:
+      entry_size = sum(os.path.getsize(os.path.join(cache_entry, filename)) for filename in os.listdir(cache_entry))
+      entries.append((os.path.getmtime(cache_entry), entry_size, cache_entry))
+    except OSError:  # evicted by another job meanwhile
+      continue
+    total_size = total_size + entry_size
+
+  for _, entry_size, cache_entry in sorted(entries):
+    if total_size <= quota:
+      break
+
+    print("Evicting", cache_entry, "from the model cache...", file=sys.stderr)
+    shutil.rmtree(cache_entry, ignore_errors=True)
+    total_size = total_size - entry_size
+
+
+def parse_size(size):
+  """'500M', '20G' or a plain number of bytes."""
+  size = str(size).strip().upper()
+  if size[-1:] in SIZE_SUFFIXES:
+    return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+  return int(size)
+
+
+def get_available_memory():
+  # Linux only; no budget elsewhere
+  try:
+    with open('/proc/meminfo') as meminfo_file:
+      for line in meminfo_file:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except IOError:
+    pass
+
+  return float('inf')
+
+
+def get_memory_estimate(task):
+  return os.path.getsize(task.train_filename) + KERNEL_CACHE_SIZE
+
+
+def run_tasks(tasks, num_workers, memory_budget):
+  """Run train_and_test on every task, biggest first, with at most num_workers
+  running at once and their estimated memory within memory_budget.  Returns
+  their SVMReports in the order of tasks."""
+  pool = Pool(processes=num_workers)
+  pending = sorted(range(len(tasks)), key=lambda i: tasks[i].cost, reverse=True)
+  running = []
+  memory_in_use = 0
+  svm_reports = [None] * len(tasks)
+
+  while len(pending) > 0 or len(running) > 0:
+    # start the biggest tasks that fit, skipping over those that don't; a task
+    # over the whole budget still runs, alone
+    for i in list(pending):
+      if len(running) >= num_workers:
+        break
+
+      memory_estimate = get_memory_estimate(tasks[i])
+      if len(running) > 0 and memory_in_use + memory_estimate > memory_budget:
+        continue
+
+      pending.remove(i)
+      running.append((i, memory_estimate, pool.apply_async(train_and_test, (tasks[i],))))
+      memory_in_use = memory_in_use + memory_estimate
+
+    time.sleep(0.1)
+
+    for i, memory_estimate, async_result in list(running):
+      if async_result.ready():
+        svm_reports[i] = async_result.get()
+        running.remove((i, memory_estimate, async_result))
+        memory_in_use = memory_in_use - memory_estimate
+
+  pool.close()
+  pool.join()
+
+  return svm_reports
+
+
+def get_timing(name, detail, start, duration, thread):
+  """A phase of a job, as the master collects them for its timing summary
+  and trace."""
+  return {'name': name, 'detail': detail, 'start': start, 'duration': duration, 'thread': thread}
+
+
+def get_task_timings(task, svm_report):
+  class_suffix = os.path.basename(task.model_filename).split('.', 1)[1]
+  thread = 'pid ' + str(svm_report.worker)
+  timings = []
+  if svm_report.time_train is not None:
+    timings.append(get_timing('svm_learn', class_suffix, svm_report.time_train[0], svm_report.time_train[1], thread))
+  if svm_report.time_test is not None:
+    timings.append(get_timing('svm_classify', class_suffix, svm_report.time_test[0], svm_report.time_test[1], thread))
+  return timings
+
+
+def write_training_view(train_filename, labels_filename, view_filename):
+  # lines labeled 0 belong to neither class of a pairwise model
+  with open(train_filename) as train_file, open(labels_filename) as labels_file, open(view_filename, 'w') as view_file:
+    for train_line, label_line in zip(train_file, labels_file):
+      label = label_line.rstrip('\n')
+      if label == '0':
+        continue
+
+      _, separator, features = train_line.partition(' ')
+      view_file.write(label + separator + features)
 
 
 def _kill(process):
@@ -37,110 +270,344 @@ def _kill(process):
   os.kill(process.pid)
 
 
-def count_for_f1(tp, fp, fn, tn, prediction_file, test_file, classes):
-  for prediction_line, test_line in zip(prediction_file, test_file):
-    actual_class = int(test_line.split(' ')[0])
-    prediction_class = int(prediction_line.strip())
+def is_binary_fresh(filename):
+  # like convert_to_binary.BinaryDataset.is_fresh, but to the second, since
+  # tar only keeps whole seconds of the mtime when folders are copied
+  try:
+    with open(os.path.join(filename + '.bin', 'meta.json')) as meta_file:
+      meta = json.load(meta_file)
+  except (IOError, OSError):
+    return False
 
-    # calculate tp, fp, fn, tn for each class
-    for eval_class in classes:
-      if actual_class == prediction_class:    # true
-        if actual_class == eval_class:          # positive
-          tp[eval_class] = tp[eval_class] + 1
-        else:                                   # negative
-          tn[eval_class] = tn[eval_class] + 1
-      else:                                   # false
-        if actual_class == eval_class:          # positive
-          fp[eval_class] = fp[eval_class] + 1
-        else:                                   # negative
-          fn[eval_class] = fn[eval_class] + 1
+  source_stat = os.stat(filename)
+  return meta['source_size'] == source_stat.st_size and int(meta['source_mtime']) == int(source_stat.st_mtime)
 
 
-if __name__ == "__main__":
-  num_threads = cpu_count()
-  svm_params = sys.argv[1]
+def read_labels(filename):
+  # use the labels column written by convert_to_binary.py when it is up to date
+  labels = array('i')
+  labels_column_filename = os.path.join(filename + '.bin', 'labels')
 
-  # find number of classes
-  classes = set()
-  with open('test') as test_file:
-    for test_line in test_file:
-      actual_class = int(test_line.split(' ')[0])
-      classes.add(actual_class)
+  if os.path.exists(labels_column_filename) and is_binary_fresh(filename):
+    with open(labels_column_filename, 'rb') as labels_column_file:
+      labels.fromfile(labels_column_file, os.path.getsize(labels_column_filename) // labels.itemsize)
+  else:
+    with open(filename) as labeled_file:
+      for line in labeled_file:
+        labels.append(int(line.split(' ', 1)[0]))
 
-  # find all train files and train N models with them
-  queue = []
-  for filename in os.listdir('.'):
+  return labels
+
+
+def count_pairs(predicted_classes, actual_classes):
+  # one pass over the test set, however many classes there are
+  return Counter(zip(actual_classes, predicted_classes))
+
+
+def get_confusion_matrix(pair_counts):
+  """Turn (actual, predicted) -> count into a matrix whose rows are actual
+  classes and columns predicted ones, both in the order of 'classes'."""
+  classes = sorted(set(actual for actual, _ in pair_counts) | set(predicted for _, predicted in pair_counts))
+  matrix = [[pair_counts[(actual, predicted)] for predicted in classes] for actual in classes]
+  return {'classes': classes, 'matrix': matrix}
+
+
+def get_scores(tp, fp, fn):
+  precision = tp/(tp+fp) if tp+fp > 0 else 0.0
+  recall = tp/(tp+fn) if tp+fn > 0 else 0.0
+  f1 = 2*(precision*recall)/(precision+recall) if precision+recall > 0 else 0.0
+  return {'f1': f1, 'precision': precision, 'recall': recall}
+
+
+def get_report(confusion):
+  classes = confusion['classes']
+  matrix = confusion['matrix']
+  actual_totals = [sum(row) for row in matrix]
+  predicted_totals = [sum(column) for column in zip(*matrix)]
+
+  # calculate f-measure for each class
+  report = {'confusion': confusion, 'classes': {}}
+  total = Counter()
+  for i, class_id in enumerate(classes):
+    if class_id == NO_CLASS:
+      continue
+
+    tp = matrix[i][i]
+    fp = predicted_totals[i] - tp
+    fn = actual_totals[i] - tp
+    report['classes'][class_id] = get_scores(tp, fp, fn)
+    total.update({'tp': tp, 'fp': fp, 'fn': fn})
+
+  # micro: pooled over classes; macro: mean of the classes' scores
+  report['micro'] = get_scores(total['tp'], total['fp'], total['fn'])
+  report['macro'] = dict((stats_type, sum(class_stats[stats_type] for class_stats in report['classes'].values())/max(1, len(report['classes'])))
+                         for stats_type in ('f1', 'precision', 'recall'))
+
+  return report
+
+
+def read_manifest():
+  # written by prepare_files.py; older fold folders don't have one
+  if not os.path.exists(MANIFEST_FILENAME):
+    return None
+
+  with open(MANIFEST_FILENAME) as manifest_file:
+    return json.load(manifest_file)
+
+
+def is_pairwise(class_files):
+  return any(class_file.filename.split('.', 1)[1].startswith('pair_') for class_file in class_files)
+
+
+def find_class_files(manifest=None):
+  # find all train files, N of them for N classes, or N(N-1)/2 of them for
+  # the N(N-1)/2 pairs of classes
+  class_files = []
+  for filename in sorted(os.listdir('.')):
     if filename.startswith('train') and len(filename) > len("train"):
-      model_filename = filename.replace('train', 'model', 1)
-      prediction_filename = filename.replace('train', 'prediction', 1)
-
-      # find -j param
-      num_pos = 0
-      num_neg = 0
-      with open(filename) as train_file:
-        for train_line in train_file:
-          klass = int(train_line.split(' ')[0])
-
-          if klass == 1:
-            num_pos = num_pos + 1
-          else:
-            num_neg = num_neg + 1
+      train_filename = filename
+      labels_filename = None
+    elif filename.startswith('labels') and len(filename) > len("labels"):
+      # shared feature layout: one train file plus a label vector per class
+      train_filename = 'train'
+      labels_filename = filename
+    else:
+      continue
+
+    # find -j param, from the manifest rather than by reading the whole file when possible
+    class_suffix = filename.split('.', 1)[1]
+    if manifest is not None and class_suffix.startswith('pair_'):
+      class_id, other_class_id = class_suffix[len('pair_'):].split('_')
+      num_pos = manifest['num_positive'][class_id]
+      num_neg = manifest['num_positive'][other_class_id]
+    elif manifest is not None:
+      class_id = class_suffix[len('class_'):]
+      num_pos = manifest['num_positive'][class_id]
+      num_neg = manifest['num_negative'][class_id]
+    else:
+      train_labels = read_labels(filename)
+      num_pos = train_labels.count(1)
+      num_neg = train_labels.count(-1)
+
+    class_files.append(ClassFile(filename, train_filename, labels_filename, num_pos, num_neg))
+
+  # e.g. train.class_N next to labels.class_N would write the same models
+  layouts = set((class_file.filename.split('.', 1)[0], class_file.filename.split('.', 1)[1].split('_', 1)[0]) for class_file in class_files)
+  if len(layouts) > 1:
+    raise ValueError("fold folder mixes " + ', '.join(sorted(prefix + '.' + kind + '_*' for prefix, kind in layouts)) + " files; prepare it again")
+
+  return class_files
 
-      this_svm_params = svm_params
-      # this_svm_params = this_svm_params + ' -j ' + str(num_neg/num_pos)
 
-      queue.append(Task(filename, model_filename, prediction_filename, this_svm_params))
+def get_tasks(class_files, svm_params, output_directory, auto_weight=False, model_cache=None):
+  """model_cache is (cache directory, data hash, svm_light hash), or None to
+  train every model."""
+  tasks = []
+  for class_file in class_files:
+    class_suffix = class_file.filename.split('.', 1)[1]
+    model_filename = os.path.join(output_directory, 'model.' + class_suffix)
+    prediction_filename = os.path.join(output_directory, 'prediction.' + class_suffix)
 
-  pool = Pool(processes=num_threads)
-  prediction_filenames = pool.map(train_and_test, queue)
+    this_svm_params = svm_params
+    if auto_weight and class_file.num_pos > 0:
+      this_svm_params = this_svm_params + ' -j ' + str(class_file.num_neg/class_file.num_pos)
 
-  # generate final prediction
-  prediction_files = dict()
-  for prediction_filename in prediction_filenames:
-    class_id = int(prediction_filename[len('prediction.class_'):])
-    prediction_files[class_id] = open(prediction_filename)
+    # svm_learn takes longer on bigger files and on more balanced classes
+    cost = (os.path.getsize(class_file.train_filename), min(class_file.num_pos, class_file.num_neg))
 
-  print(prediction_files, file=sys.stderr)
+    cache_entry = None
+    if model_cache is not None:
+      cache_directory, data_hash, svm_light_hash = model_cache
+      cache_entry = os.path.join(cache_directory, get_model_key(data_hash, class_suffix, this_svm_params, svm_light_hash))
 
-  with open('prediction', 'w') as final_prediction_file:
+    tasks.append(Task(class_file.train_filename, class_file.labels_filename, model_filename, prediction_filename, this_svm_params, cost, cache_entry))
+
+  return tasks
+
+
+def merge_predictions(prediction_filenames, final_prediction_filename, threshold=None):
+  """Write the best scoring class of each test example to
+  final_prediction_filename, or NO_CLASS when no score is above threshold,
+  and return the predicted classes."""
+  class_ids = [int(os.path.basename(prediction_filename)[len('prediction.class_'):]) for prediction_filename in prediction_filenames]
+  prediction_files = [open(prediction_filename) for prediction_filename in prediction_filenames]
+
+  predicted_classes = array('i')
+  with open(final_prediction_filename, 'w') as final_prediction_file:
     while True:
-      class_lines = {class_id: prediction_file.readline().strip() for class_id, prediction_file in prediction_files.items()}
+      # a chunk of rows at a time, as one column of scores per class
+      columns = [array('d', [float(line) for line in islice(prediction_file, MERGE_CHUNK_SIZE)]) for prediction_file in prediction_files]
+      if len(columns[0]) == 0:
+        break
 
-      try:
-        max_key = max(class_lines.iterkeys(), key=lambda k: float(class_lines[k]))
-      except ValueError:  # happens when float('') -> we reached EOF
+      rows = list(zip(*columns))
+      max_scores = [max(row) for row in rows]
+      best_classes = [class_ids[row.index(max_score)] for row, max_score in zip(rows, max_scores)]
+      if threshold is not None:
+        best_classes = [NO_CLASS if max_score <= threshold else best_class for best_class, max_score in zip(best_classes, max_scores)]
+
+      final_prediction_file.write(''.join(str(best_class) + '\n' for best_class in best_classes))
+      predicted_classes.extend(best_classes)
+
+  for prediction_file in prediction_files:
+    prediction_file.close()
+
+  return predicted_classes
+
+
+def merge_pairwise_predictions(prediction_filenames, final_prediction_filename):
+  """Write the class that wins the most of its one-vs-one duels for each test
+  example to final_prediction_filename, the lowest of the classes tied, and
+  return the predicted classes."""
+  pairs = [tuple(int(class_id) for class_id in os.path.basename(prediction_filename)[len('prediction.pair_'):].split('_')) for prediction_filename in prediction_filenames]
+  class_ids = sorted(set(class_id for pair in pairs for class_id in pair))
+  prediction_files = [open(prediction_filename) for prediction_filename in prediction_filenames]
+
+  predicted_classes = array('i')
+  with open(final_prediction_filename, 'w') as final_prediction_file:
+    while True:
+      columns = [array('d', [float(line) for line in islice(prediction_file, MERGE_CHUNK_SIZE)]) for prediction_file in prediction_files]
+      if len(columns[0]) == 0:
         break
-      
-      max_score = float(class_lines[max_key])
 
-      # TODO: add a flag
-      # if max_score <= 0:
-      #   best_class = -1
-      # else:
-      #   best_class = max_key
-      best_class = max_key
+      # a column of votes per class, a pair's model voting for its first class on positive scores
+      votes = dict((class_id, array('i', [0]) * len(columns[0])) for class_id in class_ids)
+      for (class_id, other_class_id), column in zip(pairs, columns):
+        class_votes = votes[class_id]
+        other_class_votes = votes[other_class_id]
+        for row, score in enumerate(column):
+          if score > 0:
+            class_votes[row] += 1
+          else:
+            other_class_votes[row] += 1
+
+      vote_columns = [votes[class_id] for class_id in class_ids]
+      best_classes = [class_ids[row.index(max(row))] for row in zip(*vote_columns)]
 
-      final_prediction_file.write(str(best_class) + '\n')
+      final_prediction_file.write(''.join(str(best_class) + '\n' for best_class in best_classes))
+      predicted_classes.extend(best_classes)
 
-  for prediction_file in prediction_files.itervalues():
+  for prediction_file in prediction_files:
     prediction_file.close()
 
-  # calculate f-measure and stuff
-  tp = Counter()
-  fp = Counter()
-  fn = Counter()
-  tn = Counter()
-  with open('prediction') as prediction_file, open('test') as test_file:
-    count_for_f1(tp=tp, fp=fp, fn=fn, tn=tn, prediction_file=prediction_file, test_file=test_file, classes=classes)
+  return predicted_classes
 
-  # calculate f-measure for each class
-  report = {}
-  for class_id in classes:
-    precision = tp[class_id]/(tp[class_id]+fp[class_id])
-    recall = tp[class_id]/(tp[class_id]+fn[class_id])
-    try:
-      report[class_id] = {'f1': 2*(precision*recall)/(precision+recall), 'precision': precision, 'recall': recall}
-    except ZeroDivisionError:
-      report[class_id] = {'f1': 0.0, 'precision': precision, 'recall': recall}
 
-  print(json.dumps(report), end='')
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--workers', type=int, default=cpu_count(), help="number of models to train at once")
+  parser.add_argument('--memory-budget', type=parse_size, default=None,
+                      help="memory the models being trained at once may take together, e.g. 8G "
+                           "(defaults to the memory available when starting)")
+  parser.add_argument('--batch', action='store_true',
+                      help="train and test every given svm_params in its own params_N folder and print a JSON object "
+                           "mapping each svm_params to its report")
+  parser.add_argument('--threshold', type=float, default=None,
+                      help="predict " + str(NO_CLASS) + " for examples whose best score is not above this")
+  parser.add_argument('--auto-weight', action='store_true',
+                      help="weigh training errors on positive examples by #negatives/#positives of each class (svm_learn -j)")
+  parser.add_argument('--model-cache', default=None,
+                      help="folder of models, predictions and reports shared by the jobs on this machine")
+  parser.add_argument('--model-cache-quota', type=parse_size, default=parse_size('10G'),
+                      help="size beyond which the least recently used entries of --model-cache are removed")
+  parser.add_argument('--data-hash', default=None,
+                      help="hash of this folder's contents, which --model-cache entries are keyed by")
+  parser.add_argument('svm_params', nargs='*')
+  args = parser.parse_args()
+
+  num_threads = args.workers
+  svm_params_list = args.svm_params or ['']
+  assert args.batch or len(svm_params_list) == 1, "more than one svm_params needs --batch"
+
+  actual_classes = read_labels('test')
+
+  class_files = find_class_files(read_manifest())
+  pairwise = is_pairwise(class_files)
+  if pairwise and args.threshold is not None:
+    print("Ignoring --threshold, which applies to one-vs-all scores, for pairwise models...", file=sys.stderr)
+
+  model_cache = None
+  if args.model_cache is not None and args.data_hash is not None:
+    if not os.path.isdir(args.model_cache):
+      os.makedirs(args.model_cache)
+    model_cache = (args.model_cache, args.data_hash, get_svm_light_hash())
+
+  # reports of svm_params this folder was already evaluated with
+  reports = {}
+  report_entries = {}
+  if model_cache is not None:
+    for svm_params in svm_params_list:
+      report_entries[svm_params] = os.path.join(args.model_cache, get_report_key(args.data_hash, svm_params, model_cache[2], args.auto_weight, args.threshold))
+      try:
+        os.utime(report_entries[svm_params], None)
+        with open(os.path.join(report_entries[svm_params], 'report.json')) as report_file:
+          reports[svm_params] = json.load(report_file)
+        print("Using cached report for", svm_params, "from", report_entries[svm_params] + "...", file=sys.stderr)
+      except (IOError, OSError):
+        pass
+  cached_svm_params = set(reports.keys())
+
+  # one task per (svm_params, class), all through one pool
+  output_directories = []
+  queue = []
+  for params_id, svm_params in enumerate(svm_params_list):
+    if args.batch:
+      output_directory = 'params_' + str(params_id)
+      if not os.path.isdir(output_directory):
+        os.mkdir(output_directory)
+    else:
+      output_directory = '.'
+
+    output_directories.append(output_directory)
+    if svm_params not in cached_svm_params:
+      queue.extend(get_tasks(class_files, svm_params, output_directory, args.auto_weight, model_cache))
+
+  memory_budget = args.memory_budget
+  if memory_budget is None:
+    memory_budget = get_available_memory()
+
+  svm_reports = run_tasks(queue, num_threads, memory_budget)
+
+  # run_tasks keeps the order of queue, so each svm_params left owns a run of len(class_files) tasks
+  num_evaluated = 0
+  timings = {}
+  main_thread = 'pid ' + str(os.getpid())
+  for params_id, svm_params in enumerate(svm_params_list):
+    if svm_params in cached_svm_params:
+      continue
+
+    params_slice = slice(num_evaluated*len(class_files), (num_evaluated+1)*len(class_files))
+    timings[svm_params] = []
+    for task, svm_report in zip(queue[params_slice], svm_reports[params_slice]):
+      timings[svm_params].extend(get_task_timings(task, svm_report))
+
+    final_prediction_filename = os.path.join(output_directories[params_id], 'prediction')
+    merge_start = time.time()
+    if pairwise:
+      predicted_classes = merge_pairwise_predictions([svm_report.prediction_filename for svm_report in svm_reports[params_slice]], final_prediction_filename)
+    else:
+      predicted_classes = merge_predictions([svm_report.prediction_filename for svm_report in svm_reports[params_slice]], final_prediction_filename, args.threshold)
+    timings[svm_params].append(get_timing('merge', output_directories[params_id], merge_start, time.time() - merge_start, main_thread))
+
+    evaluate_start = time.time()
+    reports[svm_params] = get_report(get_confusion_matrix(count_pairs(predicted_classes, actual_classes)))
+    timings[svm_params].append(get_timing('evaluate', output_directories[params_id], evaluate_start, time.time() - evaluate_start, main_thread))
+    num_evaluated = num_evaluated + 1
+
+    if model_cache is not None:
+      report_filename = os.path.join(output_directories[params_id], 'report.json')
+      with open(report_filename, 'w') as report_file:
+        json.dump(reports[svm_params], report_file)
+      store_in_cache(report_entries[svm_params], {'report.json': report_filename})
+
+  if model_cache is not None:
+    evict_from_cache(args.model_cache, args.model_cache_quota)
+
+  # timings are of this run only, so they stay out of the cached reports
+  for svm_params, params_timings in timings.items():
+    reports[svm_params]['timings'] = params_timings
+
+  if args.batch:
+    print(json.dumps(reports), end='')
+  else:
+    print(json.dumps(reports[svm_params_list[0]]), end='')